@@ -21,6 +21,10 @@ class CommandDispatcher(object):
 
         self.command_tagsets = {}
 
+        self.version = 0 # incremented on command registration and removal, see invalidate()
+        self._available = {} # (chat_id, conv_id): available commands, see get_available_commands()
+        self._available_key = None
+
         """
         inbuilt argument preprocessors, recognises:
         * one_chat_id (also resolves #conv)
@@ -45,6 +49,9 @@ class CommandDispatcher(object):
             r"^(#?[\w|]+[^#]\|)?@[\w]+[^@]$": self.one_chat_id,
             r"^#[\w|]+[^#]$": self.one_conv_id }}
 
+        # group name: (source preprocessors, combined regex, [(regex, callee)]), see _compiled_preprocessors()
+        self._compiled = {}
+
         """
         disable implicit argument preprocessors on some commands
         these are special use-cases that should be rare with supplied functionality
@@ -67,42 +74,24 @@ class CommandDispatcher(object):
             # current user chat_id
             subtokens[-1] = internal_context.user.id_.chat_id
         else:
-            user_memory = self.bot.get_memory_option("user_data")
-            if all_users:
-                chat_ids = list(self.bot.conversations.catalog[internal_context.conv_id]["participants"])
-            else:
-                chat_ids = list(user_memory.keys())
-
-            matched_users = {}
-            for chat_id in chat_ids:
-                user_data = user_memory[chat_id]
-                if "_hangups" in user_data:
-                    if "nickname" in user_data:
-                        nickname_lower =  user_data["nickname"].lower()
-                    else:
-                        nickname_lower = ""
-                    fullname_lower = user_data["_hangups"]["full_name"].lower()
-
-                    if text == nickname_lower:
-                        matched_users[chat_id] = chat_id
-                        break
-
-                    elif( text in fullname_lower or
-                            text in fullname_lower.replace(" ", "") ):
-                        matched_users[chat_id] = chat_id
+            """users are matched by nickname, or by prefix of a word in their full name,
+            see nameindex.NameIndex. participants of the current conversation are searched
+            first, so a name that is unique within the conversation always resolves"""
+            names = self.bot.conversations.name_index()
+            text = text.lower()
+
+            matched_users = set()
+            if not all_users and internal_context.conv_id in self.bot.conversations.catalog:
+                participants = self.bot.conversations.catalog[internal_context.conv_id]["participants"]
+                matched_users = names.find(text, within=participants, limit=1)
+
+            if not matched_users:
+                matched_users = names.find(text, limit=1)
 
             if len(matched_users) == 1:
-                subtokens[-1] = list(matched_users)[0]
+                subtokens[-1] = next(iter(matched_users))
             elif len(matched_users) == 0:
-                if not all_users:
-                    # redo the user search, expanded to all users
-                    # since this is calling itself again, completely overwrite subtokens
-                    subtokens = self.one_chat_id(
-                        token,
-                        internal_context,
-                        all_users=True ).split("|", 1)
-                else:
-                    raise ValueError("{} returned no users".format(token))
+                raise ValueError("{} returned no users".format(token))
             else:
                 raise ValueError("{} returned more than one user".format(token))
 
@@ -127,6 +116,37 @@ class CommandDispatcher(object):
 
         return "|".join(subtokens)
 
+    @staticmethod
+    def _compile_preprocessors(preprocessors):
+        """compile a preprocessor group { pattern: callee } into (combined regex, [(regex, callee)])
+        the combined regex is an alternation of all patterns, so arguments that match none of them
+          are rejected with a single match, it is None if the patterns cannot be combined
+          (e.g. numbered backreferences or inline flags)"""
+        table = [ (re.compile(pattern, re.IGNORECASE), callee) for pattern, callee in preprocessors.items() ]
+
+        combined = None
+        # backreferences are numbered across the whole alternation, and inline flags such as
+        #   (?x) apply to all of it, so neither can be combined
+        if( table
+                and all(regex.flags == table[0][0].flags for regex, callee in table)
+                and not any(re.search(r"\\\d|\(\?P=|\(\?[aiLmsux]+\)", pattern) for pattern in preprocessors) ):
+            try:
+                combined = re.compile( "|".join([ "(?:{})".format(pattern) for pattern in preprocessors ]),
+                                       re.IGNORECASE )
+            except re.error:
+                pass
+
+        return combined, table
+
+    def _compiled_preprocessors(self, name):
+        """compiled form of the named group, recompiled if the group was replaced or registered again"""
+        preprocessors = self.preprocessors[name]
+        compiled = self._compiled.get(name)
+        if compiled is None or compiled[0] is not preprocessors:
+            compiled = (preprocessors,) + self._compile_preprocessors(preprocessors)
+            self._compiled[name] = compiled
+        return compiled[1], compiled[2]
+
     def preprocess_arguments(self, args, internal_context, force_trigger="", force_groups=[]):
         """custom preprocessing for use by other plugins, specify:
         * force_trigger word to override config, default
@@ -252,8 +272,11 @@ class CommandDispatcher(object):
             for rname in [ rname
                           for rname in apply_resolvers
                           if rname in all_groups ]:
-                for pattern, callee in self.preprocessors[rname].items():
-                    if re.match(pattern, arg, flags=re.IGNORECASE):
+                combined, table = self._compiled_preprocessors(rname)
+                if combined and not combined.match(arg):
+                    continue
+                for regex, callee in table:
+                    if regex.match(arg):
                         try:
                             _arg = callee(arg, internal_context)
                             if _arg:
@@ -298,6 +321,11 @@ class CommandDispatcher(object):
             tagsets = set([tagsets])
 
         self.command_tagsets[command] = self.command_tagsets[command] | tagsets
+        self.invalidate()
+
+    def invalidate(self):
+        """call after changing commands, admin_commands or command_tagsets directly"""
+        self.version = self.version + 1
 
 
     @property
@@ -311,6 +339,25 @@ class CommandDispatcher(object):
         return config_tags_escalate
 
     def get_available_commands(self, bot, chat_id, conv_id):
+        """return { "admin": [...], "user": [...] } commands available to chat_id in conv_id
+        results are cached until commands, config, tags or the conversation catalog change"""
+        cache_key = (self.version, bot.config.version, bot.tags.version, bot.conversations.version)
+        if cache_key != self._available_key:
+            self._available.clear()
+            self._available_key = cache_key
+
+        available = self._available.get((chat_id, conv_id))
+        if available is None:
+            available = self._get_available_commands(bot, chat_id, conv_id)
+            available = { "admin": tuple(available["admin"]), "user": tuple(available["user"]) }
+
+            # unknown users have no tags yet, they may be added to memory at any time
+            if bot.memory.exists(["user_data", chat_id]):
+                self._available[(chat_id, conv_id)] = available
+
+        return { "admin": list(available["admin"]), "user": list(available["user"]) }
+
+    def _get_available_commands(self, bot, chat_id, conv_id):
         start_time = time.time()
 
         config_tags_deny_prefix = self.deny_prefix
@@ -430,6 +477,8 @@ class CommandDispatcher(object):
         setattr(event, 'command_module', func.__module__ )
         setattr(event, 'command_path', func.__module__ + '.' + command_name)
 
+        started = bot.latency.timer()
+
         try:
             args = list(args[1:])
             args = self.preprocess_arguments(args, internal_context=event)
@@ -446,6 +495,9 @@ class CommandDispatcher(object):
                 "<b><pre>{0}</pre></b> <pre>{1}</pre>: <em><pre>{2}</pre></em>".format(
                     func.__name__, type(e).__name__, str(e)) )
 
+        finally:
+            bot.latency.since("commands", event.command_path, started)
+
     def register(self, *args, admin=False, tags=None, final=False):
         """Decorator for registering command"""
 
@@ -458,6 +510,7 @@ class CommandDispatcher(object):
                 self.commands[func_name] = func
                 if admin:
                     self.admin_commands.append(func_name)
+                self.invalidate()
 
             else:
                 # just register and return the same function
@@ -485,9 +538,18 @@ class CommandDispatcher(object):
         return func
 
     def register_argument_preprocessor_group(self, name, preprocessors):
+        """register (or update) a group { pattern: callee }, a group modified in-place must
+        be registered again to be recompiled"""
         name_lower = name.lower()
         self.preprocessors[name_lower] = preprocessors
+        # the same dict may be registered again after in-place changes
+        self._compiled.pop(name_lower, None)
+        self._compiled_preprocessors(name_lower)
         plugins.tracking.register_command_argument_preprocessors_group(name_lower)
 
+    def deregister_argument_preprocessor_group(self, name):
+        self.preprocessors.pop(name, None)
+        self._compiled.pop(name, None)
+
 # CommandDispatcher singleton
 command = CommandDispatcher()
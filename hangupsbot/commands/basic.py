@@ -274,6 +274,53 @@ def resourcememory(bot, event, *args):
     yield from bot.coro_send_message(event.conv,  "<b>" + message + "</b>")
 
 
+@command.register(admin=True)
+def latency(bot, event, *args):
+    """show p50/p95/p99 wall time per handler, command and send stage
+    optionally supply a category (handlers, commands, send), or "reset" to clear all histograms"""
+
+    if args and args[0] == "reset":
+        bot.latency.reset()
+        yield from bot.coro_send_message(event.conv, "<em>latency histograms cleared</em>")
+        return
+
+    category = args[0] if args else None
+
+    if category and category not in bot.latency.known_categories():
+        yield from bot.coro_send_message(event.conv, "<em>unknown category {}, use one of: {}</em>".format(
+            category, ", ".join(bot.latency.known_categories())))
+        return
+
+    lines = []
+    for category, summaries in bot.latency.summary(category).items():
+        if not summaries:
+            continue
+        lines.append("<b>{}</b>".format(category))
+        for key, summary in sorted(summaries.items(), key=lambda item: item[1]["p95"], reverse=True):
+            lines.append("... `{}` x{count}: p50 {p50:.3f}s, p95 {p95:.3f}s, p99 {p99:.3f}s, max {max:.3f}s".format(
+                key, **summary))
+
+    if not lines:
+        lines.append("<em>no timings recorded</em>")
+
+    yield from bot.coro_send_message(event.conv, "<br />".join(lines))
+
+
+@command.register(admin=True)
+def sendqueue(bot, event, *args):
+    """show outbound queue depth per conversation, delivery counts and send latency"""
+    stats = bot.send_queue.stats()
+
+    lines = [ "<b>queued:</b> {queued}, <b>sent:</b> {sent}, <b>retried:</b> {retried}, <b>failed:</b> {failed}".format(**stats) ]
+    for conv_id, depth in sorted(stats["conversations"].items(), key=lambda item: item[1], reverse=True):
+        lines.append("... `{}`: {}".format(conv_id, depth))
+
+    for key, summary in sorted(bot.latency.summary("send")["send"].items()):
+        lines.append("<b>{}</b> x{count}: p50 {p50:.3f}s, p95 {p95:.3f}s, p99 {p99:.3f}s".format(key, **summary))
+
+    yield from bot.coro_send_message(event.conv, "<br />".join(lines))
+
+
 @command.register_unknown
 def unknown_command(bot, event, *args):
     """handle unknown commands"""
@@ -7,7 +7,7 @@ logger = logging.getLogger(__name__)
 
 
 def _initialise(bot):
-    plugins.register_admin_command(["dumpconv", "dumpunknownusers", "resetunknownusers", "refreshusermemory", "removeconvrecord", "makeallusersindefinite"])
+    plugins.register_admin_command(["dumpconv", "dumpunknownusers", "resetunknownusers", "refreshusermemory", "removeconvrecord", "makeallusersindefinite", "memoryexport", "memorystats"])
 
 
 def dumpconv(bot, event, *args):
@@ -95,3 +95,25 @@ def makeallusersindefinite(bot, event, *args):
     logger.info("makeallusersindefinite finished")
 
     yield from bot.coro_send_message(event.conv, "<b>please see log/console</b>")
+
+
+def memoryexport(bot, event, *args):
+    """export memory as a JSON file in the original memory.json layout, optionally to the supplied path"""
+    filename = args[0] if args else bot.memory.filename + ".export"
+
+    bot.memory.flush()
+    bot.memory.export(filename)
+
+    yield from bot.coro_send_message(event.conv, "<b>memory exported to {}</b>".format(filename))
+
+
+def memorystats(bot, event, *args):
+    """show memory storage writes and the number of changes per top-level key"""
+    stats = bot.memory.stats()
+
+    lines = [ "<b>storage:</b> {} (pending: {})".format(stats["storage"], stats["pending"]),
+              "<b>writes:</b> {writes} ({bytes} bytes, {duration:.3f}s)".format(**stats["saves"]) ]
+    for key, count in sorted(stats["churn"].items(), key=lambda item: item[1], reverse=True):
+        lines.append("... `{}`: {}".format(key, count))
+
+    yield from bot.coro_send_message(event.conv, "<br />".join(lines))
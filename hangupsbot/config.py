@@ -1,133 +1,448 @@
-import collections, datetime, functools, json, glob, logging, os, shutil, sys, time
+import asyncio, collections, functools, json, logging, threading, time
 
-from threading import Timer
+import storage
 
 
 logger = logging.getLogger(__name__)
 
 
+def _track(value, parent, key):
+    """return loaded value as a tracked container attached to parent[key], nested containers included
+    tracked containers are copies, so only data that no caller holds a reference to is converted"""
+    _type = type(value)
+    if _type is dict:
+        return TrackedDict(value, parent, key)
+    elif _type is list:
+        return TrackedList(value, parent, key)
+    return value
+
+
+def _attached(value, parent, key):
+    """value read from parent[key]: reattach a moved tracked container so its path stays correct,
+    or mark a plain container for the next write, as the caller who stored it may change it in-place"""
+    _type = type(value)
+    if _type in (TrackedDict, TrackedList):
+        value._parent = parent
+        value._key = key
+    elif _type in (dict, list):
+        config, path = _owner(parent, key)
+        config._touch(path)
+    return value
+
+
+def _owner(container, key=None):
+    """(owning Config, full path of container[key])"""
+    path = [] if key is None else [key]
+    node = container
+    while isinstance(node, (TrackedDict, TrackedList)):
+        path.append(node._key)
+        node = node._parent
+    path.reverse()
+    return node, path
+
+
+def _report(container, op, key=None):
+    """walk up to the owning Config and record the change with the full path"""
+    config, path = _owner(container, key)
+    config._record_change(op, path)
+
+
+class TrackedDict(dict):
+    """dict stored inside a Config, reports in-place changes by path
+    loaded data is converted when its top-level key is first read, values stored later are kept
+    as they are: plain containers stay untracked, and are written again whenever they are read
+    through their parent or set again"""
+    __slots__ = ("_parent", "_key")
+
+    def __init__(self, value, parent, key):
+        super().__init__(value)
+        self._parent = parent
+        self._key = key
+        for _key, item in dict.items(self):
+            if type(item) in (dict, list):
+                dict.__setitem__(self, _key, _track(item, self, _key))
+
+    def __getitem__(self, key):
+        return _attached(dict.__getitem__(self, key), self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        _report(self, "set", key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        _report(self, "pop", key)
+
+    def pop(self, key, *args):
+        if key not in self:
+            return dict.pop(self, key, *args)
+        value = dict.pop(self, key)
+        _report(self, "pop", key)
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        _report(self, "pop", key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        _report(self)
+
+    def __reduce__(self):
+        # copies and pickles are detached plain dicts
+        return (dict, (dict(self),))
+
+
+class TrackedList(list):
+    """list stored inside a Config, any in-place change marks the whole list as changed
+    items are converted and kept like the values of a TrackedDict"""
+    __slots__ = ("_parent", "_key")
+
+    def __init__(self, value, parent, key):
+        super().__init__(value)
+        self._parent = parent
+        self._key = key
+        for index, item in enumerate(list.__iter__(self)):
+            if type(item) in (dict, list):
+                list.__setitem__(self, index, _track(item, self, index))
+
+    def __getitem__(self, index):
+        value = list.__getitem__(self, index)
+        if isinstance(index, slice):
+            return value
+        return _attached(value, self, index if index >= 0 else index + len(self))
+
+    def _changed(self):
+        _report(self, "set")
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        self._changed()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._changed()
+
+    def __iadd__(self, other):
+        list.__iadd__(self, other)
+        self._changed()
+        return self
+
+    def append(self, value):
+        list.append(self, value)
+        self._changed()
+
+    def extend(self, values):
+        list.extend(self, values)
+        self._changed()
+
+    def insert(self, index, value):
+        list.insert(self, index, value)
+        self._changed()
+
+    def pop(self, *args):
+        value = list.pop(self, *args)
+        self._changed()
+        return value
+
+    def remove(self, value):
+        list.remove(self, value)
+        self._changed()
+
+    def clear(self):
+        list.clear(self)
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed()
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
 class Config(collections.MutableMapping):
     """Configuration JSON storage class"""
-    def __init__(self, filename, default=None, failsafe_backups=0, save_delay=0):
+    def __init__(self, filename, default=None, failsafe_backups=0, save_delay=0, backend="json", backend_options=None,
+                 save_max_delay=None, cache_lookups=False):
         self.filename = filename
         self.default = None
         self.config = {}
         self.changed = False
+        self.version = 0 # incremented on every change, load, taint and save of changes, for caches of config values
+        self.listeners = [] # callables receiving (op, keys_list) for every recorded change, keys_list is
+                            #   empty when the whole config was replaced or tainted
+
+        # get_suboption() results, valid while version is unchanged, see get_suboption()
+        self.cache_lookups = cache_lookups
+        self._lookups = {} # (grouping, groupname, keyname): value
+        self._lookups_version = None
         self.failsafe_backups = failsafe_backups
         self.save_delay = save_delay
-        self.load()
+        self.save_max_delay = max(save_max_delay or save_delay * 5, save_delay)
 
-        self._timer_save = False
+        self.save_stats = { "writes": 0,
+                            "bytes": 0,
+                            "duration": 0.0,
+                            "last_bytes": 0,
+                            "last_duration": 0.0 }
 
-    def _make_failsafe_backup(self):
-        try:
-            with open(self.filename) as f:
-                json.load(f)
-        except IOError:
-            return False
-        except ValueError:
-            logger.warning("{} is corrupted, aborting backup".format(self.filename))
-            return False
+        # pending path -> op records since the last save, None forces a full write
+        self._changes = collections.OrderedDict()
 
-        existing = sorted(glob.glob(self.filename + ".*.bak"))
-        while len(existing) > (self.failsafe_backups - 1):
-            os.remove(existing.pop(0))
+        # number of changes per top-level key since load
+        self.churn = collections.Counter()
 
-        backup_file = self.filename + "." + datetime.datetime.now().strftime("%Y%m%d%H%M%S") + ".bak"
-        shutil.copy2(self.filename, backup_file)
+        self.storage = storage.create( backend,
+                                       filename,
+                                       failsafe_backups=failsafe_backups,
+                                       **(backend_options or {}) )
 
-        return True
+        # nested containers are only tracked when the backend can write them individually
+        self._tracked = self.storage.incremental
 
-    def _recover_from_failsafe(self):
-        existing = sorted(glob.glob(self.filename + ".*.bak"))
-        while len(existing) > 0:
-            try:
-                recovery_filename = existing.pop()
-                with open(recovery_filename) as f:
-                    # test the file is valid json
-                    json.load(f)
-
-                shutil.copy2(recovery_filename, self.filename)
-                self.load(recovery=True)
-                logger.info("recovery successful: {}".format(recovery_filename))
-                return True
-            except IOError:
-                pass
-            except ValueError:
-                logger.error("corrupted recovery: {}".format(self.filename))
-        return False
+        self.load()
 
-    def load(self, recovery=False):
-        """Load config from file"""
-        try:
-            with open(self.filename) as f:
-                self.config = json.load(f)
-            logger.info("{} read".format(self.filename))
+        # write-behind state, owned by the event loop
+        self._loop = asyncio.get_event_loop()
+        self._save_handle = None
+        self._save_first_request = None
+        self._save_last_request = None
+        self._save_running = False
+        # snapshots are numbered and written in that order, see _snapshot() and _write()
+        self._write_turn = threading.Condition()
+        self._snapshots_taken = 0
+        self._snapshots_written = 0
+
+    def _touch(self, keys_list):
+        """mark a path for the next write without recording a change, see _attached()"""
+        if self._changes is None:
+            return
 
-        except IOError:
-            self.config = {}
+        self.changed = True
+        path = tuple(keys_list)
+        if path not in self._changes:
+            self._changes[path] = "set"
+
+    def _record_change(self, op, keys_list):
+        """track changed paths for incremental storage backends
+        only the latest operation per path is kept, values are read when saving"""
+        self.changed = True
+        self.version = self.version + 1
+        self._notify(op, keys_list)
+
+        if keys_list:
+            self.churn[keys_list[0]] += 1
 
-        except ValueError:
-            if not recovery and self.failsafe_backups > 0 and self._recover_from_failsafe():
-                return
+        if self._changes is None:
+            return
 
-            raise
+        path = tuple(keys_list)
+        self._changes.pop(path, None)
+        self._changes[path] = op
 
+    def load(self, recovery=False):
+        """Load config from file"""
+        self.config = self.storage.load()
+        self._stored = set()
         self.changed = False
+        self.version = self.version + 1
+        self._changes = collections.OrderedDict()
+        self._notify("load", [])
+
+    def stats(self):
+        """storage write statistics and per top-level key change counts"""
+        return { "storage": type(self.storage).__name__,
+                 "pending": len(self._changes) if self._changes is not None else "all",
+                 "saves": dict(self.save_stats),
+                 "churn": dict(self.churn) }
 
     def force_taint(self):
+        """mark the entire config as changed, use after modifying nested values in-place"""
         self.changed = True
+        self.version = self.version + 1
+        self._changes = None
+        self._notify("taint", [])
+
+    def _notify(self, op, keys_list):
+        for listener in self.listeners:
+            try:
+                listener(op, keys_list)
+            except Exception:
+                logger.exception("{} change listener failed".format(self.filename))
 
     def loads(self, json_str):
         """Load config from JSON string"""
         self.config = json.loads(json_str)
-        self.changed = True
+        self._stored = set()
+        self.force_taint()
 
     def save(self, delay=True):
-        if self.save_delay:
-            if delay:
-                if self._timer_save and self._timer_save.is_alive():
-                    self._timer_save.cancel()
-                self._timer_save = Timer(self.save_delay, self.save, [], {"delay": False})
-                self._timer_save.start()
-                return False
-
-        """Save config to file (only if config has changed)"""
+        """Save config to file (only if config has changed)
+        with save_delay, the write is deferred and coalesced on the event loop: it happens
+        save_delay seconds after the last request, but never later than save_max_delay
+        seconds after the first unsaved request"""
+        if self.changed:
+            # nested values may have been modified in-place without a tracked change
+            self.version = self.version + 1
+
+        if self.save_delay and delay:
+            now = time.time()
+            self._save_last_request = now
+            if self._save_first_request is None:
+                self._save_first_request = now
+                # save() may be called from plugin threads
+                self._loop.call_soon_threadsafe(self._schedule_save, self.save_delay)
+            return False
+
         if self.changed:
             start_time = time.time()
+            ticket, snapshot = self._snapshot()
+            try:
+                # waits for earlier snapshots still being written in the executor
+                written = self._write(ticket, snapshot)
+            except:
+                # pending changes are unknown now, rewrite everything next time
+                self.force_taint()
+                raise
+            self._record_save(start_time, written)
 
-            if self.failsafe_backups:
-                self._make_failsafe_backup()
+        return self.changed
 
-            with open(self.filename, 'w') as f:
-                json.dump(self.config, f, indent=2, sort_keys=True)
-                self.changed = False
-            interval = time.time() - start_time
+    def _snapshot(self):
+        """(ticket, snapshot) of pending changes, the lock is only held while preparing"""
+        with self._write_turn:
+            snapshot = self._prepare_save()
+            ticket = self._snapshots_taken
+            self._snapshots_taken = self._snapshots_taken + 1
+        return ticket, snapshot
+
+    def _write(self, ticket, snapshot):
+        """write snapshot after all earlier ones, may run in an executor"""
+        with self._write_turn:
+            while self._snapshots_written != ticket:
+                self._write_turn.wait()
+        try:
+            return self.storage.write(snapshot)
+        finally:
+            with self._write_turn:
+                self._snapshots_written = self._snapshots_written + 1
+                self._write_turn.notify_all()
+
+    def _prepare_save(self):
+        """take a private snapshot of pending changes on the thread that owns the data"""
+        changes, self._changes = self._changes, collections.OrderedDict()
+        self.changed = False
+        if changes is not None:
+            changes = [ (op, list(path)) for path, op in changes.items() ]
+        return self.storage.prepare(self.config, changes)
 
-            logger.info("{} write {}".format(self.filename, interval))
+    def _record_save(self, start_time, written):
+        interval = time.time() - start_time
 
-        return self.changed
+        self.save_stats["writes"] = self.save_stats["writes"] + 1
+        self.save_stats["bytes"] = self.save_stats["bytes"] + written
+        self.save_stats["duration"] = self.save_stats["duration"] + interval
+        self.save_stats["last_bytes"] = written
+        self.save_stats["last_duration"] = interval
+
+        logger.info("{} write {} ({} bytes)".format(self.filename, interval, written))
+
+    def _schedule_save(self, delay):
+        if self._save_handle is None:
+            self._save_handle = self._loop.call_later(delay, self._save_due)
+
+    def _save_due(self):
+        self._save_handle = None
+
+        if self._save_first_request is None:
+            # flushed in the meantime
+            return
+
+        now = time.time()
+        due = min( self._save_last_request + self.save_delay,
+                   self._save_first_request + self.save_max_delay )
+
+        if now < due or self._save_running:
+            # more requests arrived, or the previous write is still in progress
+            self._schedule_save(max(due - now, 0.1))
+            return
+
+        self._save_first_request = None
+        self._loop.create_task(self._save_in_executor())
+
+    @asyncio.coroutine
+    def _save_in_executor(self):
+        if not self.changed:
+            return
+
+        self._save_running = True
+        start_time = time.time()
+        try:
+            ticket, snapshot = self._snapshot()
+            written = yield from self._loop.run_in_executor(None, self._write, ticket, snapshot)
+            self._record_save(start_time, written)
+        except Exception:
+            self.force_taint()
+            logger.exception("{} write failed".format(self.filename))
+        finally:
+            self._save_running = False
 
     def flush(self):
-        if self._timer_save and self._timer_save.is_alive():
+        if self._save_handle is not None:
             logger.info("flushing {}".format(self.filename))
-            self._timer_save.cancel()
+            self._save_handle.cancel()
+            self._save_handle = None
+        self._save_first_request = None
         self.save(delay=False)
 
+    def export(self, filename):
+        """write the complete config to a JSON file, regardless of storage backend"""
+        with open(filename, 'w') as f:
+            json.dump({ key: self.config[key] for key in self.config }, f, indent=2, sort_keys=True)
+        logger.info("{} exported to {}".format(self.filename, filename))
+
     def get_by_path(self, keys_list):
         """Get item from config by path (list of keys)"""
         return functools.reduce(lambda d, k: d[int(k) if isinstance(d, list) else k], keys_list, self)
 
     def set_by_path(self, keys_list, value):
         """Set item in config by path (list of keys)"""
-        self.get_by_path(keys_list[:-1])[keys_list[-1]] = value
-        self.changed = True
+        parent = self.get_by_path(keys_list[:-1])
+        parent[keys_list[-1]] = value
+        if not self._reports_changes(parent):
+            self._record_change("set", keys_list)
 
     def pop_by_path(self, keys_list):
-        popped_value = self.get_by_path(keys_list[:-1]).pop(keys_list[-1])
-        self.changed = True
+        parent = self.get_by_path(keys_list[:-1])
+        popped_value = parent.pop(keys_list[-1])
+        if not self._reports_changes(parent):
+            self._record_change("pop", keys_list)
         return popped_value
 
+    def _reports_changes(self, container):
+        """True if container already records its own changes (this Config or a tracked container)"""
+        return container is self or isinstance(container, (TrackedDict, TrackedList))
+
     def get_option(self, keyname):
         try:
             value = self.config[keyname]
@@ -136,12 +451,35 @@ class Config(collections.MutableMapping):
         return value
 
     def get_suboption(self, grouping, groupname, keyname):
+        """value of config[grouping][groupname][keyname], or of config[keyname] if unset
+        with cache_lookups, results are cached until the next recorded change, load, force_taint()
+          or save() of pending changes: follow in-place changes of nested values with force_taint()"""
+        if not self.cache_lookups:
+            return self._get_suboption(grouping, groupname, keyname)
+
+        if self._lookups_version != self.version:
+            self._lookups.clear()
+            self._lookups_version = self.version
+
+        lookup = (grouping, groupname, keyname)
+        try:
+            return self._lookups[lookup]
+        except KeyError:
+            value = self._lookups[lookup] = self._get_suboption(grouping, groupname, keyname)
+            return value
+
+    def _get_suboption(self, grouping, groupname, keyname):
         try:
             value = self.config[grouping][groupname][keyname]
         except KeyError:
             value = self.get_option(keyname)
         return value
 
+    def section_loaded(self, key):
+        """False if the storage backend has not read the top-level key yet (it reads it on first access)"""
+        is_loaded = getattr(self.config, "is_loaded", None)
+        return is_loaded(key) if is_loaded else True
+
     def exists(self, keys_list):
         _exists = True
 
@@ -155,17 +493,26 @@ class Config(collections.MutableMapping):
 
     def __getitem__(self, key):
         try:
-            return self.config[key]
+            value = self.config[key]
         except KeyError:
             return self.default
+        if self._tracked:
+            if type(value) in (dict, list) and key not in self._stored:
+                value = self.config[key] = _track(value, self, key)
+            else:
+                value = _attached(value, self, key)
+        return value
 
     def __setitem__(self, key, value):
         self.config[key] = value
-        self.changed = True
+        # kept as stored, see _attached()
+        self._stored.add(key)
+        self._record_change("set", [key])
 
     def __delitem__(self, key):
         del self.config[key]
-        self.changed = True
+        self._stored.discard(key)
+        self._record_change("pop", [key])
 
     def __iter__(self):
         return iter(self.config)
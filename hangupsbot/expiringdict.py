@@ -0,0 +1,79 @@
+import collections, logging, time
+
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiringDict(collections.MutableMapping):
+    """dictionary where entries expire ttl seconds after they were last set
+    * entries are kept in order of expiry, so insert, lookup and expiry are amortised O(1)
+    * if max_entries is set, the oldest entries are evicted to make room
+    * hits/misses count membership tests (key in d), expired/evicted count removed entries
+    """
+
+    def __init__(self, ttl, max_entries=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._data = collections.OrderedDict() # key: (expiry, value)
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def expire(self, now=None):
+        """remove all entries that are past their expiry, returns number removed"""
+        if now is None:
+            now = time.time()
+
+        removed = 0
+        while self._data:
+            key, (expiry, value) = next(iter(self._data.items()))
+            if expiry > now:
+                break
+            del self._data[key]
+            removed = removed + 1
+
+        self.expired = self.expired + removed
+        return removed
+
+    def stats(self):
+        return { "entries": len(self._data),
+                 "hits": self.hits,
+                 "misses": self.misses,
+                 "expired": self.expired,
+                 "evicted": self.evicted }
+
+    def __contains__(self, key):
+        self.expire()
+        if key in self._data:
+            self.hits = self.hits + 1
+            return True
+        self.misses = self.misses + 1
+        return False
+
+    def __getitem__(self, key):
+        self.expire()
+        return self._data[key][1]
+
+    def __setitem__(self, key, value):
+        self.expire()
+        self._data.pop(key, None)
+        self._data[key] = (time.time() + self.ttl, value)
+
+        if self.max_entries:
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evicted = self.evicted + 1
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __iter__(self):
+        self.expire()
+        return iter(list(self._data))
+
+    def __len__(self):
+        self.expire()
+        return len(self._data)
@@ -9,6 +9,7 @@ import hangups
 
 import plugins
 from commands import command
+from expiringdict import ExpiringDict
 
 
 logger = logging.getLogger(__name__)
@@ -17,17 +18,42 @@ logger = logging.getLogger(__name__)
 class EventHandler:
     """Handle Hangups conversation events"""
 
+    # default ttl (seconds) for each registry, see __init__()
+    _registry_defaults = { "reprocessors": 3600,
+                           "passthrus": 3600,
+                           "contexts": 3600,
+                           "image_ids": 86400, # uploaded images are reused, keep them as long as executables
+                           "executables": 86400 }
+
     def __init__(self, bot, bot_command='/bot'):
         self.bot = bot
         self.bot_command = bot_command
 
         self._prefix_reprocessor = "uuid://"
-        self._reprocessors = {}
 
-        self._passthrus = {}
-        self._contexts = {}
-        self._image_ids = {}
-        self._executables = {}
+        """registries for message metadata that survives a trip to Google
+        entries are normally consumed when the message echoes back, anything else
+        expires after a per-registry ttl or gets evicted when the registry is full"""
+
+        self._registries = {}
+        config_registry = bot.get_config_option("handlers.registry") or {}
+        for name, ttl in self._registry_defaults.items():
+            options = config_registry.get(name) or {}
+            self._registries[name] = ExpiringDict( options.get("ttl", ttl),
+                                                   max_entries=options.get("max", 10000) )
+
+        self._reprocessors = self._registries["reprocessors"]
+        self._passthrus = self._registries["passthrus"]
+        self._contexts = self._registries["contexts"]
+        self._image_ids = self._registries["image_ids"]
+        self._executables = self._registries["executables"]
+
+        self._registry_sweep_interval = config_registry.get("sweep", 60)
+
+        # futures waiting for an image_id to be associated with its public uri
+        self._image_waiters = {}
+        self._image_uri_timeout = bot.get_config_option("handlers.image_uri_timeout") or 60
+        asyncio.async(self._sweep_registries())
 
         self.pluggables = { "allmessages": [],
                             "call": [],
@@ -39,6 +65,20 @@ class EventHandler:
                             "typing": [],
                             "watermark": [] }
 
+        # per-type tuples of (priority, handlers) groups, rebuilt on register/deregister
+        self._dispatch = { type: () for type in self.pluggables }
+
+        # opt-in: handlers of equal priority run concurrently for these event types
+        #   config.handlers.concurrent = true (message, allmessages) or a list of event types
+        #   "sending" handlers modify the broadcast list in order and are never run concurrently
+        config_concurrent = bot.get_config_option("handlers.concurrent")
+        if config_concurrent is True:
+            config_concurrent = [ "allmessages", "message" ]
+        self._concurrent_types = set(config_concurrent or []) - { "sending" }
+
+        # optional timeout for coroutine handlers, override per handler with extra_metadata["handler.timeout"]
+        self._handler_timeout = bot.get_config_option("handlers.timeout")
+
         bot.register_shared( 'reprocessor.attach_reprocessor',
                              self.attach_reprocessor,
                              forgiving=True )
@@ -86,8 +126,18 @@ class EventHandler:
         if not _metadata.get("module.path"):
             raise ValueError("module.path not defined")
 
+        """accepted handler signatures:
+        coroutine(bot, event, command)
+        coroutine(bot, event)
+        function(bot, event, context)
+        function(bot, event)
+        """
+        _metadata["handler.arity"] = len(inspect.signature(_handler).parameters)
+        _metadata["handler.coroutine"] = asyncio.iscoroutinefunction(_handler)
+
         self.pluggables[type].append((_handler, priority, _metadata))
         self.pluggables[type].sort(key=lambda tup: tup[1])
+        self._rebuild_dispatch(type)
 
         plugins.tracking.register_handler(_handler, type, priority, module_path=_metadata["module.path"])
 
@@ -121,12 +171,47 @@ class EventHandler:
                     # remove from being processed
                     logger.debug("deregister {} handler {}".format(t, h))
                     self.pluggables[t].remove(h)
+                    self._rebuild_dispatch(t)
 
                     return # remove first encountered only
 
         if strict:
             raise ValueError("{} handler(s) {}".format(type, function))
 
+    def _rebuild_dispatch(self, type):
+        groups = []
+        for function, priority, metadata in self.pluggables[type]:
+            if not groups or groups[-1][0] != priority:
+                groups.append((priority, []))
+            groups[-1][1].append(( function,
+                                   metadata["handler.arity"],
+                                   metadata["handler.coroutine"],
+                                   metadata ))
+
+        self._dispatch[type] = tuple( (priority, tuple(handlers)) for priority, handlers in groups )
+
+    def has_handlers(self, type):
+        """True if at least one pluggable is registered for the event type"""
+        return bool(self._dispatch.get(type))
+
+    def registry_stats(self):
+        return { name: registry.stats() for name, registry in self._registries.items() }
+
+    @asyncio.coroutine
+    def _sweep_registries(self):
+        """expire registry entries in the background, even when nothing is accessing them
+        stops when this handler is replaced (e.g. after a reconnect)"""
+        while True:
+            yield from asyncio.sleep(self._registry_sweep_interval)
+            if self.bot._handlers is not self:
+                return
+
+            expired = { name: registry.expire()
+                        for name, registry in self._registries.items() }
+            if any(expired.values()):
+                logger.info("registries expired: {} totals: {}".format(
+                    expired, self.registry_stats()))
+
     def register_passthru(self, variable):
         _id = str(uuid.uuid4())
         self._passthrus[_id] = variable
@@ -191,29 +276,45 @@ class EventHandler:
     def image_uri_from(self, image_id, callback, *args, **kwargs):
         """XXX: there isn't a direct way to resolve an image_id to the public url without
         posting it first via the api. other plugins and functions can establish a short-lived
-        task to wait for the image id to be posted, and retrieve the url in an asyncronous way"""
+        task to wait for the image id to be posted, and retrieve the url in an asyncronous way
+        waits up to config.handlers.image_uri_timeout (default: 60) seconds"""
 
-        ticks = 0
-        while True:
-            if image_id not in self._image_ids:
-                yield from asyncio.sleep(1)
-                ticks = ticks + 1
-                if ticks > 60:
-                    return False
-            else:
-                yield from callback(self._image_ids[image_id], *args, **kwargs)
-                return True
+        image_uri = self._image_ids.get(image_id)
+
+        if image_uri is None:
+            waiter = asyncio.Future()
+            self._image_waiters.setdefault(image_id, []).append(waiter)
+            try:
+                image_uri = yield from asyncio.wait_for(waiter, self._image_uri_timeout)
+            except asyncio.TimeoutError:
+                logger.info("image_id={} was not associated in time".format(image_id))
+                return False
+            finally:
+                waiters = self._image_waiters.get(image_id)
+                if waiters is not None:
+                    if waiter in waiters:
+                        waiters.remove(waiter)
+                    if not waiters:
+                        del self._image_waiters[image_id]
+
+        yield from callback(image_uri, *args, **kwargs)
+        return True
+
+    def _resolve_image_waiters(self, image_id, image_uri):
+        for waiter in self._image_waiters.pop(image_id, []):
+            if not waiter.done():
+                waiter.set_result(image_uri)
 
     @asyncio.coroutine
     def run_reprocessor(self, id, event, *args, **kwargs):
-        if id in self._reprocessors:
-            is_coroutine = asyncio.iscoroutinefunction(self._reprocessors[id])
+        reprocessor = self._reprocessors.pop(id, None)
+        if reprocessor is not None:
+            is_coroutine = asyncio.iscoroutinefunction(reprocessor)
             logger.info("reprocessor uuid found: {} coroutine={}".format(id, is_coroutine))
             if is_coroutine:
-                yield from self._reprocessors[id](self.bot, event, id, *args, **kwargs)
+                yield from reprocessor(self.bot, event, id, *args, **kwargs)
             else:
-                self._reprocessors[id](self.bot, event, id, *args, **kwargs)
-            del self._reprocessors[id]
+                reprocessor(self.bot, event, id, *args, **kwargs)
 
     @asyncio.coroutine
     def handle_chat_message(self, event):
@@ -233,13 +334,9 @@ class EventHandler:
                     # reprocessor - process event with hidden context from handler.attach_reprocessor()
                     yield from self.run_reprocessor(annotation.value, event)
                 elif annotation.type == 1026:
-                    if annotation.value in self._passthrus:
-                        event.passthru = self._passthrus[annotation.value]
-                        del self._passthrus[annotation.value]
+                    event.passthru = self._passthrus.pop(annotation.value, event.passthru)
                 elif annotation.type == 1027:
-                    if annotation.value in self._contexts:
-                        event.context = self._contexts[annotation.value]
-                        del self._contexts[annotation.value]
+                    event.context = self._contexts.pop(annotation.value, event.context)
 
             if len(event.conv_event.segments) > 0:
                 for segment in event.conv_event.segments:
@@ -257,8 +354,7 @@ class EventHandler:
                         logger.info("auto opt-in for {}".format(event.user.id_.chat_id))
                         return
 
-            """map image ids to their public uris in absence of any fixed server api
-               XXX: small memory leak over time as each id gets cached indefinitely"""
+            """map image ids to their public uris in absence of any fixed server api"""
 
             if( event.passthru
                     and "original_request" in event.passthru
@@ -272,9 +368,9 @@ class EventHandler:
                 if _image_id not in self._image_ids:
                     self._image_ids[_image_id] = _image_uri
                     logger.info("associating image_id={} with {}".format(_image_id, _image_uri))
+                    self._resolve_image_waiters(_image_id, _image_uri)
 
-            """first occurence of an actual executable id needs to be handled as an event
-               XXX: small memory leak over time as each id gets cached indefinitely"""
+            """first occurence of an actual executable id needs to be handled as an event"""
 
             if( event.passthru and "executable" in event.passthru and event.passthru["executable"] ):
                 if event.passthru["executable"] not in self._executables:
@@ -389,51 +485,80 @@ class EventHandler:
 
     @asyncio.coroutine
     def run_pluggable_omnibus(self, name, *args, **kwargs):
-        if name in self.pluggables:
+        if name in self._dispatch:
+            concurrent = name in self._concurrent_types
+
             try:
-                for function, priority, plugin_metadata in self.pluggables[name]:
-                    message = ["{}: {}.{}".format(
-                                name,
-                                plugin_metadata["module.path"],
-                                function.__name__)]
-
-                    try:
-                        """accepted handler signatures:
-                        coroutine(bot, event, command)
-                        coroutine(bot, event)
-                        function(bot, event, context)
-                        function(bot, event)
-                        """
-                        _expected = list(inspect.signature(function).parameters)
-                        _passed = args[0:len(_expected)]
-                        if asyncio.iscoroutinefunction(function):
-                            message.append("coroutine")
-                            logger.debug(" : ".join(message))
-                            yield from function(*_passed)
-                        else:
-                            message.append("function")
-                            logger.debug(" : ".join(message))
-                            function(*_passed)
-                    except self.bot.Exceptions.SuppressHandler:
-                        # skip this pluggable, continue with next
-                        message.append("SuppressHandler")
-                        logger.debug(" : ".join(message))
-                        pass
-                    except (self.bot.Exceptions.SuppressEventHandling,
-                            self.bot.Exceptions.SuppressAllHandlers):
-                        # skip all pluggables, decide whether to handle event at next level
-                        raise
-                    except:
-                        message = " : ".join(message)
-                        logger.exception(message)
+                for priority, handlers in self._dispatch[name]:
+                    if concurrent and len(handlers) > 1:
+                        yield from self._run_handler_group(name, handlers, args)
+                    else:
+                        for handler in handlers:
+                            yield from self._run_handler(name, handler, args)
 
             except self.bot.Exceptions.SuppressAllHandlers:
                 # skip all other pluggables, but let the event continue
-                message.append("SuppressAllHandlers")
-                logger.debug(" : ".join(message))
+                logger.debug("{}: SuppressAllHandlers".format(name))
+
+    @asyncio.coroutine
+    def _run_handler(self, name, handler, args):
+        """run a single handler, only SuppressEventHandling and SuppressAllHandlers are raised"""
+        function, arity, is_coroutine, plugin_metadata = handler
+        debug = logger.isEnabledFor(logging.DEBUG)
+        started = self.bot.latency.timer()
+
+        try:
+            if is_coroutine:
+                if debug:
+                    logger.debug(self._describe_handler(name, handler, "coroutine"))
+                timeout = plugin_metadata.get("handler.timeout", self._handler_timeout)
+                if timeout:
+                    yield from asyncio.wait_for(function(*args[0:arity]), timeout)
+                else:
+                    yield from function(*args[0:arity])
+            else:
+                if debug:
+                    logger.debug(self._describe_handler(name, handler, "function"))
+                function(*args[0:arity])
+
+        except self.bot.Exceptions.SuppressHandler:
+            # skip this pluggable, continue with next
+            if debug:
+                logger.debug(self._describe_handler(name, handler, "SuppressHandler"))
+
+        except (self.bot.Exceptions.SuppressEventHandling,
+                self.bot.Exceptions.SuppressAllHandlers):
+            # skip all pluggables, decide whether to handle event at next level
+            raise
 
-            except:
-                raise
+        except asyncio.TimeoutError:
+            logger.warning(self._describe_handler(name, handler, "timeout"))
+
+        except:
+            logger.exception(self._describe_handler(name, handler, "exception"))
+
+        finally:
+            self.bot.latency.since( "handlers",
+                                    "{}.{}".format(plugin_metadata["module.path"], function.__name__),
+                                    started )
+
+    @asyncio.coroutine
+    def _run_handler_group(self, name, handlers, args):
+        """run handlers of equal priority concurrently
+        suppression is applied once the whole group has finished, SuppressEventHandling first"""
+        results = yield from asyncio.gather(
+            *[ self._run_handler(name, handler, args) for handler in handlers ],
+            return_exceptions=True )
+
+        for exception_type in ( self.bot.Exceptions.SuppressEventHandling,
+                                self.bot.Exceptions.SuppressAllHandlers ):
+            for result in results:
+                if isinstance(result, exception_type):
+                    raise result
+
+    def _describe_handler(self, name, handler, status):
+        function, arity, is_coroutine, plugin_metadata = handler
+        return "{}: {}.{} : {}".format(name, plugin_metadata["module.path"], function.__name__, status)
 
 class HandlerBridge:
     """shim for xmikosbot handler decorator"""
@@ -80,12 +80,14 @@ class HangupsConversation(hangups.conversation.Conversation):
         current_participant = []
         participant_data = []
         read_state = []
+        users = []
 
-        participants = permamem_conv["participants"][:] # use a clone
+        participants = list(permamem_conv["participants"]) # use a clone
         participants.append(bot_user["chat_id"])
         participants = set(participants)
         for chat_id in participants:
             hangups_user = bot.get_hangups_user(chat_id)
+            users.append(hangups_user)
 
             UserID = hangups.user.UserID(chat_id=hangups_user.id_.chat_id, gaia_id=hangups_user.id_.gaia_id)
             current_participant.append(UserID)
@@ -145,9 +147,13 @@ class HangupsConversation(hangups.conversation.Conversation):
         self._events_dict = {}
         self._send_message_lock = asyncio.Lock()
 
+        # instances are cached by the bot, and discarded when a participant changes
+        self._cached_users = users
+        self.participant_ids = participants
+
     @property
     def users(self):
-        return [ self.bot.get_hangups_user(part.id_.chat_id) for part in self._conversation.participant_data ]
+        return list(self._cached_users)
 
 
 class FakeConversation(object):
@@ -158,6 +164,14 @@ class FakeConversation(object):
 
     @asyncio.coroutine
     def send_message(self, message, image_id=None, otr_status=None, context=None):
+        """send the message and wait until it has been delivered"""
+        return (yield from self.enqueue_message( message,
+                                                 image_id = image_id,
+                                                 otr_status = otr_status,
+                                                 context = context ))
+
+    def enqueue_message(self, message, image_id=None, otr_status=None, context=None):
+        """queue the message for ordered delivery, returns a future that resolves once delivered"""
 
         """ChatMessageSegment: parse message"""
 
@@ -237,16 +251,17 @@ class FakeConversation(object):
             type = 1027,
             value = self.bot._handlers.register_context(context) ))
 
-        """send the message"""
-
-        with (yield from asyncio.Lock()):
-            yield from self._client.send_chat_message(
-                hangups.hangouts_pb2.SendChatMessageRequest(
-                    request_header = self._client.get_request_header(),
-                    message_content = hangups.hangouts_pb2.MessageContent( segment=serialised_segments ),
-                    existing_media = media_attachment,
-                    annotation = annotations,
-                    event_request_header = hangups.hangouts_pb2.EventRequestHeader(
-                        conversation_id=hangups.hangouts_pb2.ConversationId( id=self.id_ ),
-                        client_generated_id=self._client.get_client_generated_id(),
-                        expected_otr = otr_status )))
+        """send the message: the request is built once, so retries reuse the same client_generated_id"""
+
+        request = hangups.hangouts_pb2.SendChatMessageRequest(
+            request_header = self._client.get_request_header(),
+            message_content = hangups.hangouts_pb2.MessageContent( segment=serialised_segments ),
+            existing_media = media_attachment,
+            annotation = annotations,
+            event_request_header = hangups.hangouts_pb2.EventRequestHeader(
+                conversation_id=hangups.hangouts_pb2.ConversationId( id=self.id_ ),
+                client_generated_id=self._client.get_client_generated_id(),
+                expected_otr = otr_status ))
+
+        return self.bot.send_queue.enqueue( self.id_,
+                                            lambda: self._client.send_chat_message(request) )
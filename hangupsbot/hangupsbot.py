@@ -17,6 +17,9 @@ import sinks
 import plugins
 
 from exceptions import HangupsBotExceptions
+from expiringdict import ExpiringDict
+from latency import LatencyTracker
+from sendqueue import SendQueue
 from event import (TypingEvent, WatermarkEvent, ConversationEvent)
 from hangups_conversation import (HangupsConversation, FakeConversation)
 
@@ -47,17 +50,29 @@ class HangupsBot(object):
         self._user_list = None # hangups.UserList
         self._handlers = None # handlers.py::EventHandler
 
-        self._cache_event_id = {} # workaround for duplicate events
+        self._cache_event_id = None # workaround for duplicate events, see _on_event()
+        self._conversation_cache = {} # conv_id: HangupsConversation, see get_hangups_conversation()
+        self._status_windows = {} # (type, conv_id, chat_id): latest pending notification, see _on_status_changes()
+        self._config_layers = {} # (conv_id, option): layered values, see get_config_layers()
+        self._config_layers_key = None
 
         self._locales = {}
 
         # Load config file
         try:
-            self.config = config.Config(config_path)
+            self.config = config.Config(config_path, cache_lookups=True)
         except ValueError:
             logging.exception("failed to load config, malformed json")
             sys.exit()
 
+        # wall time histograms for handlers, commands and message sending
+        self.latency = LatencyTracker(
+            slow_threshold = self.get_config_option('latency.slow_threshold') or 2.0 )
+
+        # ordered outbound messages, rate-shaped only when configured in config.send_queue
+        _send_queue = self.get_config_option('send_queue') or {}
+        self.send_queue = SendQueue(self, **_send_queue)
+
         # set localisation if anything defined in config.language or ENV[HANGOUTSBOT_LOCALE]
         _language = self.get_config_option('language') or os.environ.get("HANGOUTSBOT_LOCALE")
         if _language:
@@ -68,16 +83,29 @@ class HangupsBot(object):
         if memory_file:
             _failsafe_backups = int(self.get_config_option('memory-failsafe_backups') or 3)
             _save_delay = int(self.get_config_option('memory-save_delay') or 1)
-
-            logger.info("memory = {}, failsafe = {}, delay = {}".format(
-                memory_file, _failsafe_backups, _save_delay))
-
-            self.memory = config.Config(memory_file, failsafe_backups=_failsafe_backups, save_delay=_save_delay)
-            if not os.path.isfile(memory_file):
+            _save_max_delay = int(self.get_config_option('memory-save_max_delay') or _save_delay * 5)
+            _backend = self.get_config_option('memory-storage') or "json"
+            _backend_options = {}
+            if _backend == "journal":
+                _backend_options["compact_after"] = int(self.get_config_option('memory-journal_compact') or 500)
+            elif _backend == "sqlite":
+                _backend_options["database"] = self.get_config_option('memory-sqlite_file')
+
+            logger.info("memory = {}, failsafe = {}, delay = {}, storage = {}".format(
+                memory_file, _failsafe_backups, _save_delay, _backend))
+
+            self.memory = config.Config( memory_file,
+                                         failsafe_backups=_failsafe_backups,
+                                         save_delay=_save_delay,
+                                         save_max_delay=_save_max_delay,
+                                         backend=_backend,
+                                         backend_options=_backend_options )
+            if not os.path.isfile(memory_file) and _backend != "sqlite":
                 try:
                     logger.info("creating memory file: {}".format(memory_file))
                     self.memory.force_taint()
-                    self.memory.save()
+                    # not deferred, so an unwritable memory file fails here
+                    self.memory.save(delay=False)
 
                 except (OSError, IOError) as e:
                     logger.exception('FAILED TO CREATE DEFAULT MEMORY FILE')
@@ -271,7 +299,24 @@ class HangupsBot(object):
         if isinstance(conv_id, (FakeConversation, hangups.conversation.Conversation)):
             conv_id = conv_id.id_
 
-        return HangupsConversation(self, conv_id)
+        if conv_id not in self._conversation_cache:
+            self._conversation_cache[conv_id] = HangupsConversation(self, conv_id)
+
+        return self._conversation_cache[conv_id]
+
+    def invalidate_hangups_conversation(self, conv_id=None, chat_id=None):
+        """discard cached HangupsConversation objects
+        * conv_id: the specified conversation
+        * chat_id: every conversation with the user as a participant
+        * neither: everything"""
+        if conv_id:
+            self._conversation_cache.pop(conv_id, None)
+        elif chat_id:
+            for conv_id in [ conv_id for conv_id, conv in self._conversation_cache.items()
+                             if chat_id in conv.participant_ids ]:
+                del self._conversation_cache[conv_id]
+        else:
+            self._conversation_cache.clear()
 
     def get_hangups_user(self, user_id):
         hangups_user = False
@@ -344,6 +389,38 @@ class HangupsBot(object):
     def get_config_suboption(self, conv_id, option):
         return self.config.get_suboption("conversations", conv_id, option)
 
+    def get_config_layers(self, conv_id, option):
+        """values of option explicitly set for conv_id, then for each tag active in conv_id
+        (as conversations["TAG:<tag>"], in tag order) and then globally (conversations["GLOBAL"],
+        then the top-level option), most specific first and without unset layers
+        use to merge per-conversation, per-tag and global lists"""
+        cache_key = (self.config.version, self.tags.version, self.conversations.version)
+        if cache_key != self._config_layers_key:
+            self._config_layers.clear()
+            self._config_layers_key = cache_key
+
+        lookup = (conv_id, option)
+        if lookup not in self._config_layers:
+            layers = [ conv_id ] + [ "TAG:" + tag for tag in sorted(self.tags.convactive(conv_id)) ] + [ "GLOBAL" ]
+
+            values = []
+            for layer in layers:
+                if self.config.exists(["conversations", layer, option]):
+                    values.append(self.config.get_by_path(["conversations", layer, option]))
+            if self.config.exists([option]):
+                values.append(self.config.get_by_path([option]))
+
+            self._config_layers[lookup] = values
+
+        return list(self._config_layers[lookup])
+
+    def get_config_layered(self, conv_id, option, default=None):
+        """most specific value of option for conv_id: conversation, then its tags, then global"""
+        layers = self.get_config_layers(conv_id, option)
+        if layers:
+            return layers[0]
+        return default
+
     def get_memory_option(self, option):
         return self.memory.get_option(option)
 
@@ -402,12 +479,9 @@ class HangupsBot(object):
             conversation = FakeConversation(self, conversation_id)
            #logger.info(_("memory: {} is 1on1 with {}").format(conversation_id, chat_id))
         else:
-            for c in self.list_conversations():
-                if len(c.users) == 2:
-                    for u in c.users:
-                        if u.id_.chat_id == chat_id:
-                            conversation = c
-                            break
+            conversation_id = self.conversations.get_1to1_id(chat_id)
+            if conversation_id:
+                conversation = self.get_hangups_conversation(conversation_id)
 
             if conversation is not None:
                 # remember the conversation so we don't have to do this again
@@ -482,12 +556,9 @@ class HangupsBot(object):
                 a chat invite only - a message sent on the channel auto-accepts the invite)
                 """
                 #logger.info("get_1on1: searching for existing 1to1 with {}".format(chat_id))
-                for c in self.list_conversations():
-                    if len(c.users) == 2:
-                        for u in c.users:
-                            if u.id_.chat_id == chat_id:
-                                conversation = c
-                                break
+                conversation_id = self.conversations.get_1to1_id(chat_id)
+                if conversation_id:
+                    conversation = self.get_hangups_conversation(conversation_id)
 
             if conversation is not None:
                 # remember the conversation so we don't have to do this again
@@ -530,6 +601,8 @@ class HangupsBot(object):
 
         logger.debug("connected")
 
+        started = time.time()
+
         plugins.tracking.set_bot(self)
         command.set_tracking(plugins.tracking)
         command.set_bot(self)
@@ -550,8 +623,13 @@ class HangupsBot(object):
             yield from hangups.build_user_conversation_list(self._client)
         )
 
+        # cached conversations reference the previous client
+        self.invalidate_hangups_conversation()
+
         self.conversations = yield from permamem.initialise_permanent_memory(self)
 
+        initialised_permamem = time.time()
+
         plugins.load(self, "commands.plugincontrol")
         plugins.load(self, "commands.basic")
         plugins.load(self, "commands.tagging")
@@ -563,29 +641,68 @@ class HangupsBot(object):
         self._conv_list.on_event.add_observer(self._on_event)
         self._client.on_state_update.add_observer(self._on_status_changes)
 
-        logger.info("bot initialised")
+        logger.info("bot initialised in {:.2f}s (permamem {:.2f}s, plugins {:.2f}s)".format(
+            time.time() - started, initialised_permamem - started, time.time() - initialised_permamem))
 
 
     def _on_status_changes(self, state_update):
         notification_type = state_update.WhichOneof('state_update')
         if notification_type == 'typing_notification':
+            handler_type = "typing"
+            notification = state_update.typing_notification
+        elif notification_type == 'watermark_notification':
+            handler_type = "watermark"
+            notification = state_update.watermark_notification
+        else:
+            """
+            XXX: Unsupported State Updates (state_update):
+            re: https://github.com/tdryer/hangups/blob/9a27ecd0cbfd94acf8959e89c52ac3250c920a1f/hangups/hangouts.proto#L1034
+            """
+            return
+
+        if not self._handlers.has_handlers(handler_type):
+            # nothing would receive the event, don't build it
+            return
+
+        """coalesce status updates per conversation and user, config.status_updates.window (seconds, 0 to disable)
+        the first update is delivered immediately, further updates within the window are reduced to the
+        latest one, delivered when the window closes"""
+        window = self.get_config_option('status_updates.window')
+        if window is None:
+            window = 1
+        if window:
+            key = (handler_type, notification.conversation_id.id, notification.sender_id.chat_id)
+            if key in self._status_windows:
+                self._status_windows[key] = notification
+                return
+            self._open_status_window(key, window)
+
+        self._dispatch_status(handler_type, notification)
+
+    def _open_status_window(self, key, window):
+        self._status_windows[key] = None
+        asyncio.get_event_loop().call_later(window, self._close_status_window, key, window)
+
+    def _close_status_window(self, key, window):
+        pending = self._status_windows.pop(key, None)
+        if pending is not None:
+            # deliver the latest state, and keep limiting updates for another window
+            self._open_status_window(key, window)
+            self._dispatch_status(key[0], pending)
+
+    def _dispatch_status(self, handler_type, notification):
+        if handler_type == "typing":
             asyncio.async(
                 self._handlers.handle_typing_notification(
-                    TypingEvent(self, state_update.typing_notification)
+                    TypingEvent(self, notification)
                 )
             ).add_done_callback(lambda future: future.result())
-        elif notification_type == 'watermark_notification':
+        else:
             asyncio.async(
                 self._handlers.handle_watermark_notification(
-                    WatermarkEvent(self, state_update.watermark_notification)
+                    WatermarkEvent(self, notification)
                 )
             ).add_done_callback(lambda future: future.result())
-        elif notification_type == 'event_notification':
-            """
-            XXX: Unsupported State Updates (state_update):
-            re: https://github.com/tdryer/hangups/blob/9a27ecd0cbfd94acf8959e89c52ac3250c920a1f/hangups/hangouts.proto#L1034
-            """
-            pass
 
 
     @asyncio.coroutine
@@ -595,18 +712,26 @@ class HangupsBot(object):
         self._execute_hook("on_event", conv_event)
 
         if self.get_config_option('workaround.duplicate-events'):
+            if self._cache_event_id is None:
+                self._cache_event_id = ExpiringDict(
+                    self.get_config_option('workaround.duplicate-events.window') or 3,
+                    max_entries=self.get_config_option('workaround.duplicate-events.max') or 1000 )
+
             if conv_event.id_ in self._cache_event_id:
-                logger.warning("duplicate event {} ignored".format(conv_event.id_))
+                logger.warning("duplicate event {} ignored (duplicates: {}/{})".format(
+                    conv_event.id_, self._cache_event_id.hits, self._cache_event_id.misses))
                 return
 
-            self._cache_event_id = {k: v for k, v in self._cache_event_id.items() if v > time.time()-3}
-            self._cache_event_id[conv_event.id_] = time.time()
+            self._cache_event_id[conv_event.id_] = conv_event.timestamp
 
             logger.info("duplicate events workaround: event id = {} timestamp = {}".format(
                 conv_event.id_, conv_event.timestamp))
 
         event = ConversationEvent(self, conv_event)
 
+        if isinstance(conv_event, (hangups.MembershipChangeEvent, hangups.RenameEvent, hangups.OTREvent)):
+            self.conversations.conversation_changed(conv_event.conversation_id)
+
         yield from self.conversations.update(self._conv_list.get(conv_event.conversation_id),
                                              source="event")
 
@@ -706,10 +831,18 @@ class HangupsBot(object):
 
 
     @asyncio.coroutine
-    def coro_send_message(self, conversation, message, context=None, image_id=None):
+    def coro_send_message(self, conversation, message, context=None, image_id=None, wait=True):
+        """send a message (and any broadcasts added by sending handlers) and wait until every
+        message has been delivered or has failed, failures are returned instead of raised
+        wait=False only queues the messages and returns a future for their delivery instead:
+        messages are queued per conversation, so ordering is kept without waiting"""
+
+        delivered = asyncio.Future()
+
         if not message and not image_id:
             # at least a message OR an image_id must be supplied
-            return
+            delivered.set_result([])
+            return (yield from delivered) if wait else delivered
 
         # get the context
 
@@ -736,18 +869,24 @@ class HangupsBot(object):
 
         # run any sending handlers
 
+        started = self.latency.timer()
+
         try:
             yield from self._handlers.run_pluggable_omnibus("sending", self, broadcast_list, context)
         except self.Exceptions.SuppressEventHandling:
             logger.info("message sending: SuppressEventHandling")
-            return
+            delivered.set_result([])
+            return (yield from delivered) if wait else delivered
         except:
             raise
+        finally:
+            self.latency.since("send", "sending handlers", started)
 
         logger.debug("message sending: global context = {}".format(context))
 
         # begin message sending.. for REAL!
 
+        deliveries = []
         for response in broadcast_list:
             logger.debug("message sending: {}".format(response[0]))
 
@@ -755,12 +894,16 @@ class HangupsBot(object):
 
             _fc = FakeConversation(self, response[0])
 
-            try:
-                yield from _fc.send_message( response[1],
-                                             image_id = response[2],
-                                             context = context )
-            except hangups.NetworkError as e:
-                logger.exception("CORO_SEND_MESSAGE: error sending {}".format(response[0]))
+            deliveries.append(_fc.enqueue_message( response[1],
+                                                   image_id = response[2],
+                                                   context = context ))
+
+        # failed deliveries are logged by the send queue, and returned here instead of raised
+        delivered = asyncio.gather(*deliveries, return_exceptions=True)
+        if not wait:
+            return delivered
+
+        return (yield from delivered)
 
 
     @asyncio.coroutine
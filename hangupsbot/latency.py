@@ -0,0 +1,96 @@
+import collections, logging, math, time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """log-bucketed latency histogram, constant memory regardless of call count
+    * buckets grow by a factor of 2^(1/4), so reported percentiles are within ~19% of actual
+    * durations are in seconds
+    """
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    MINIMUM = 0.0001 # 0.1ms, everything faster lands in the first bucket
+    GROWTH = 2 ** 0.25
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, duration):
+        if duration > self.MINIMUM:
+            index = int(math.log(duration / self.MINIMUM, self.GROWTH)) + 1
+        else:
+            index = 0
+
+        self.buckets[index] += 1
+        self.count = self.count + 1
+        self.total = self.total + duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, percent):
+        """upper bound of the bucket containing the requested percentile"""
+        if not self.count:
+            return 0.0
+
+        threshold = self.count * percent / 100
+        cumulative = 0
+        for index in sorted(self.buckets):
+            cumulative = cumulative + self.buckets[index]
+            if cumulative >= threshold:
+                return min(self.MINIMUM * self.GROWTH ** index, self.max)
+
+        return self.max
+
+    def summary(self):
+        return { "count": self.count,
+                 "mean": self.total / self.count if self.count else 0.0,
+                 "max": self.max,
+                 "p50": self.percentile(50),
+                 "p95": self.percentile(95),
+                 "p99": self.percentile(99) }
+
+
+class LatencyTracker:
+    """per-key wall time histograms, grouped by category (handlers, commands, send)
+    durations exceeding slow_threshold seconds are logged as warnings"""
+
+    categories = ("commands", "handlers", "send") # recorded by the bot, plugins may add more
+
+    def __init__(self, slow_threshold=None):
+        self.slow_threshold = slow_threshold
+        self.histograms = collections.defaultdict(dict)
+
+    def record(self, category, key, duration):
+        histograms = self.histograms[category]
+        if key not in histograms:
+            histograms[key] = Histogram()
+        histograms[key].record(duration)
+
+        if self.slow_threshold and duration > self.slow_threshold:
+            logger.warning("slow {}: {} took {:.3f}s".format(category, key, duration))
+
+    def timer(self):
+        return time.perf_counter()
+
+    def since(self, category, key, started):
+        """record the time elapsed since started (from timer())"""
+        self.record(category, key, time.perf_counter() - started)
+
+    def summary(self, category=None):
+        """{ category: { key: summary } }, optionally for a single category"""
+        categories = [category] if category else sorted(self.histograms)
+        return { category: { key: histogram.summary()
+                             for key, histogram in self.histograms.get(category, {}).items() }
+                 for category in categories }
+
+    def known_categories(self):
+        return sorted(set(self.categories) | set(self.histograms))
+
+    def reset(self):
+        self.histograms.clear()
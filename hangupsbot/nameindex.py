@@ -0,0 +1,114 @@
+import bisect, logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class NameIndex:
+    """resolve a lower-cased name fragment to chat_ids without scanning user memory
+    * a nickname matches exactly, and wins if only one user has it
+    * a full name matches by prefix of any of its words, or of the whole name without spaces
+    prefixes are looked up by bisecting a sorted list of (key, chat_id), which is
+      much smaller than a character trie over the same keys
+    """
+
+    def __init__(self):
+        self._users = {} # chat_id: (full_name, nickname, name keys) as indexed
+        self._keys = [] # sorted (name key, chat_id)
+        self._nicknames = {} # lower-cased nickname: set(chat_id)
+
+    @staticmethod
+    def name_keys(full_name):
+        full_name = full_name.lower()
+        keys = set(full_name.split())
+        keys.add(full_name.replace(" ", ""))
+        keys.discard("")
+        return tuple(sorted(keys))
+
+    def build(self, users):
+        """replace the index with users, an iterable of (chat_id, full_name, nickname)"""
+        self._users = {}
+        self._nicknames = {}
+
+        keys = []
+        for chat_id, full_name, nickname in users:
+            name_keys = self.name_keys(full_name)
+            self._users[chat_id] = (full_name, nickname, name_keys)
+            keys.extend([ (key, chat_id) for key in name_keys ])
+            if nickname:
+                self._nicknames.setdefault(nickname.lower(), set()).add(chat_id)
+
+        keys.sort()
+        self._keys = keys
+
+    def update(self, chat_id, full_name, nickname=None):
+        indexed = self._users.get(chat_id)
+        if indexed and indexed[:2] == (full_name, nickname):
+            return
+
+        self.remove(chat_id)
+
+        name_keys = self.name_keys(full_name)
+        self._users[chat_id] = (full_name, nickname, name_keys)
+        for key in name_keys:
+            bisect.insort(self._keys, (key, chat_id))
+        if nickname:
+            self._nicknames.setdefault(nickname.lower(), set()).add(chat_id)
+
+    def remove(self, chat_id):
+        indexed = self._users.pop(chat_id, None)
+        if indexed is None:
+            return
+
+        full_name, nickname, name_keys = indexed
+        for key in name_keys:
+            index = bisect.bisect_left(self._keys, (key, chat_id))
+            if index < len(self._keys) and self._keys[index] == (key, chat_id):
+                del self._keys[index]
+
+        if nickname:
+            chat_ids = self._nicknames.get(nickname.lower())
+            if chat_ids:
+                chat_ids.discard(chat_id)
+                if not chat_ids:
+                    del self._nicknames[nickname.lower()]
+
+    def find(self, text, within=None, limit=None):
+        """set of chat_ids matching text, optionally restricted to the chat_ids in within
+        with limit, stops once more than limit users have matched"""
+        if within is not None:
+            within = set(within)
+
+        nicknamed = self._nicknames.get(text, set())
+        if within is not None:
+            nicknamed = nicknamed & within
+        if len(nicknamed) == 1:
+            return set(nicknamed)
+
+        matched = set(nicknamed)
+
+        if within is not None and len(within) < len(self._users):
+            # small subsets, e.g. conversation participants, are cheaper to check directly
+            for chat_id in within:
+                if limit and len(matched) > limit:
+                    break
+                indexed = self._users.get(chat_id)
+                if indexed and any(key.startswith(text) for key in indexed[2]):
+                    matched.add(chat_id)
+            return matched
+
+        index = bisect.bisect_left(self._keys, (text,))
+        while index < len(self._keys):
+            if limit and len(matched) > limit:
+                break
+            key, chat_id = self._keys[index]
+            if not key.startswith(text):
+                break
+            if within is None or chat_id in within:
+                matched.add(chat_id)
+            index = index + 1
+
+        return matched
+
+    def __len__(self):
+        return len(self._users)
@@ -1,9 +1,11 @@
-import asyncio, datetime, logging, random, re
+import asyncio, collections, datetime, functools, logging, random, re, sys, time
 
 import hangups
 
 import hangups_shim
 
+import nameindex
+
 bot = None
 
 
@@ -32,19 +34,94 @@ def name_from_hangups_conversation(conv):
 
 @asyncio.coroutine
 def initialise_permanent_memory(bot):
+    """config.permamem.deferred = true: load the catalog from memory only, and reconcile
+    with hangups in a background task so plugins can load and respond immediately"""
     permamem = conversation_memory(bot)
+    permamem.watch_user_list()
 
-    yield from permamem.standardise_memory()
-    yield from permamem.load_from_memory()
-    yield from permamem.load_from_hangups()
-
-    permamem.stats()
+    yield from permamem.timed("standardise", permamem.standardise_memory())
 
-    permamem.bot.memory.save() # only if tainted
+    if bot.get_config_option("permamem.deferred"):
+        yield from permamem.timed("catalog", permamem.load_catalog())
+        asyncio.async(permamem.reconcile())
+    else:
+        yield from permamem.reconcile()
 
     return permamem
 
 
+@functools.lru_cache(maxsize=256)
+def compile_filter(filter):
+    """parse a conversation_memory.get() filter into a tuple of (operator, kind, argument)
+    operator is one of start, and, or - kind is one of:
+    * all: blank term
+    * id: id:<conv id>
+    * convid: bare <conv id>
+    * text: text:<case-insensitive title substring>
+    * chat_id: chat_id:<user chat id>
+    * tag: tag:<tag>
+    * type: type:<group|one_to_one>
+    * minusers/maxusers: minusers:<count>, maxusers:<count>
+    * random: random:<selection threshold>
+    """
+
+    terms = []
+    raw_filter = filter.strip()
+    operator = "start"
+    while raw_filter.startswith("("):
+        tokens = re.split(r"(?<!\\)(?:\\\\)*\)", raw_filter, maxsplit=1)
+        terms.append([operator, tokens[0][1:]])
+        if len(tokens) == 2:
+            raw_filter = tokens[1]
+            if not raw_filter:
+                # finished consuming entire string
+                pass
+            elif re.match(r"^\s*and\s*\(", raw_filter, re.IGNORECASE):
+                operator = "and"
+                raw_filter = tokens[1][raw_filter.index('('):].strip()
+            elif re.match(r"^\s*or\s*\(", raw_filter, re.IGNORECASE):
+                operator = "or"
+                raw_filter = tokens[1][raw_filter.index('('):].strip()
+            else:
+                raise ValueError("invalid boolean operator near \"{}\"".format(raw_filter.strip()))
+
+    if raw_filter or len(terms)==0:
+        # second condition is to ensure at least one term, even if blank
+        terms.append([operator, raw_filter])
+
+    compiled = []
+    for operator, term in terms:
+        if not term:
+            compiled.append((operator, "all", None))
+        elif term.startswith("id:"):
+            compiled.append((operator, "id", term[3:]))
+        elif term.startswith("text:"):
+            compiled.append((operator, "text", term[5:].lower()))
+        elif term.startswith("chat_id:"):
+            compiled.append((operator, "chat_id", term[8:]))
+        elif term.startswith("tag:"):
+            compiled.append((operator, "tag", term[4:]))
+        elif term.startswith("type:"):
+            compiled.append((operator, "type", term[5:].lower()))
+        elif term.startswith("minusers:"):
+            compiled.append((operator, "minusers", int(term[9:])))
+        elif term.startswith("maxusers:"):
+            compiled.append((operator, "maxusers", int(term[9:])))
+        elif term.startswith("random:"):
+            compiled.append((operator, "random", float(term[7:])))
+        else:
+            compiled.append((operator, "convid", term))
+
+    return tuple(compiled)
+
+
+def intern_value(value):
+    """share repeated ids and values through the interpreter string table"""
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
 class conversation_memory:
     bot = None
     catalog = {}
@@ -54,6 +131,96 @@ class conversation_memory:
     def __init__(self, bot):
         self.bot = bot
         self.catalog = {}
+        self._catalog_loaded = False # set by load_catalog(), which deferred startup runs early
+
+        """reverse indexes of self.catalog, maintained by _index() and _unindex()
+        1-to-1 conversations are always between the bot and one other user,
+        so the user pair is keyed by the other user's chat_id"""
+        self.convs_by_chat_id = {} # chat_id: set(conv_id)
+        self.convs_by_type = {} # lower-cased type: set(conv_id)
+        self.one_to_one = {} # chat_id: conv_id
+
+        self.version = 0 # incremented on every catalog change, see get()
+
+        self.timings = collections.OrderedDict() # startup phase: seconds
+
+        # change detection, see store_user_memory() and update()
+        self._user_fingerprints = {} # chat_id: (fingerprint, stored state)
+        self._conv_fingerprints = {} # conv_id: fingerprint
+        self._conv_versions = {} # conv_id: version, see conversation_changed()
+        self._user_names = None # chat_id: (full_name, first_name), set by watch_user_list()
+        self._filter_cache = {} # filter: tuple(conv_id) in catalog order
+        self._filter_cache_key = None
+        self._positions = {} # conv_id: position in catalog, valid while _filter_cache_key is unchanged
+
+        # user names, built on first use and then kept current from memory changes, see name_index()
+        self.names = nameindex.NameIndex()
+        self._names_stale = True
+
+    def _index(self, conv_id, convdata):
+        self.version = self.version + 1
+
+        for chat_id in convdata["participants"]:
+            self.convs_by_chat_id.setdefault(chat_id, set()).add(conv_id)
+
+        self.convs_by_type.setdefault(convdata["type"].lower(), set()).add(conv_id)
+
+        if convdata["type"] == "ONE_TO_ONE" and len(convdata["participants"]) == 1:
+            self.one_to_one[convdata["participants"][0]] = conv_id
+
+    def _unindex(self, conv_id):
+        if conv_id not in self.catalog:
+            return
+
+        self.version = self.version + 1
+
+        convdata = self.catalog[conv_id]
+
+        for chat_id in convdata["participants"]:
+            conv_ids = self.convs_by_chat_id.get(chat_id)
+            if conv_ids:
+                conv_ids.discard(conv_id)
+                if not conv_ids:
+                    del self.convs_by_chat_id[chat_id]
+
+            if self.one_to_one.get(chat_id) == conv_id:
+                del self.one_to_one[chat_id]
+
+        conv_ids = self.convs_by_type.get(convdata["type"].lower())
+        if conv_ids:
+            conv_ids.discard(conv_id)
+            if not conv_ids:
+                del self.convs_by_type[convdata["type"].lower()]
+
+    def get_1to1_id(self, chat_id):
+        """conv_id of the known 1-to-1 between the bot and chat_id, or None"""
+        return self.one_to_one.get(chat_id)
+
+    @asyncio.coroutine
+    def timed(self, phase, coro):
+        """run coro, recording its wall time in self.timings"""
+        started = time.time()
+        try:
+            return (yield from coro)
+        finally:
+            self.timings[phase] = time.time() - started
+
+    @asyncio.coroutine
+    def reconcile(self):
+        """complete user records from memory, then bring the catalog up-to-date with hangups"""
+        try:
+            yield from self.timed("memory", self.load_from_memory())
+            yield from self.timed("hangups", self.load_from_hangups())
+
+            self.stats()
+
+            self.bot.memory.save() # only if tainted
+
+        except Exception as e:
+            logger.exception("reconciliation failed")
+
+        logger.info("startup timings: {}".format(
+            ", ".join([ "{} {:.2f}s".format(phase, seconds) for phase, seconds in self.timings.items() ])))
 
     def stats(self):
         logger.info("total conversations: {}".format(len(self.catalog)))
@@ -85,6 +252,9 @@ class conversation_memory:
             memory_updated = True
 
         convs = self.bot.memory.get_by_path(['convmem'])
+
+        _remembered_1on1 = None # conv_id: chat_id, built on first use from user_data
+
         for conv_id in convs:
             conv = convs[conv_id]
             attribute_modified = False
@@ -113,13 +283,13 @@ class conversation_memory:
                     attribute_modified = True
                 else:
                     if self.bot.memory.exists(["user_data"]):
-                        """inefficient one-off search"""
-                        for chat_id in self.bot.memory["user_data"]:
-                            if self.bot.memory.exists(["user_data", chat_id, "1on1"]):
-                                if self.bot.memory["user_data"][chat_id]["1on1"] == conv_id:
-                                    conv["type"] = "ONE_TO_ONE"
-                                    attribute_modified = True
-                                    break
+                        if _remembered_1on1 is None:
+                            _remembered_1on1 = { user_data["1on1"]: chat_id
+                                                 for chat_id, user_data in self.bot.memory["user_data"].items()
+                                                 if "1on1" in user_data }
+                        if conv_id in _remembered_1on1:
+                            conv["type"] = "ONE_TO_ONE"
+                            attribute_modified = True
 
             if attribute_modified:
                 self.bot.memory.set_by_path(['convmem', conv_id], conv)
@@ -127,6 +297,86 @@ class conversation_memory:
 
         return memory_updated
 
+    @asyncio.coroutine
+    def load_catalog(self):
+        """load "persisted" conversations from memory.json into self.catalog"""
+
+        self.compact_memory()
+
+        if self.bot.memory.exists(['convmem']):
+            convs = self.bot.memory.get_by_path(['convmem'])
+            for convid in convs:
+                self._unindex(convid)
+                self.catalog[convid] = convs[convid]
+                self._index(convid, self.catalog[convid])
+
+        self._catalog_loaded = True
+
+    def compact_memory(self):
+        """intern ids repeated across user_data and convmem, so every copy shares one string
+        values are equal before and after, so this bypasses change tracking and needs no save
+        user_data is skipped if the storage backend has not read it yet, to keep startup lazy"""
+
+        if self.bot.memory.section_loaded("user_data") and self.bot.memory.exists(["user_data"]):
+            for chat_id, user_data in dict.items(self.bot.memory.get_by_path(["user_data"])):
+                if not isinstance(user_data, dict):
+                    continue
+                if "1on1" in user_data:
+                    dict.__setitem__(user_data, "1on1", intern_value(dict.__getitem__(user_data, "1on1")))
+                _hangups = dict.get(user_data, "_hangups")
+                if isinstance(_hangups, dict):
+                    for key in ("chat_id", "gaia_id"):
+                        if key in _hangups:
+                            dict.__setitem__(_hangups, key, intern_value(dict.__getitem__(_hangups, key)))
+
+        if self.bot.memory.exists(["convmem"]):
+            for conv_id, conv in dict.items(self.bot.memory.get_by_path(["convmem"])):
+                participants = dict.get(conv, "participants")
+                if isinstance(participants, list):
+                    list.__setitem__(participants, slice(None), [ intern_value(chat_id) for chat_id in participants ])
+                for key in ("type", "source"):
+                    if key in conv:
+                        dict.__setitem__(conv, key, intern_value(dict.__getitem__(conv, key)))
+
+    def name_index(self):
+        """NameIndex of all cached users, with their nicknames"""
+        if self._names_stale:
+            if self._on_memory_change not in self.bot.memory.listeners:
+                self.bot.memory.listeners.append(self._on_memory_change)
+
+            users = []
+            if self.bot.memory.exists(["user_data"]):
+                for chat_id, user_data in dict.items(self.bot.memory.get_by_path(["user_data"])):
+                    if isinstance(user_data, dict) and "_hangups" in user_data:
+                        users.append(( chat_id,
+                                       dict.get(user_data, "_hangups").get("full_name") or "",
+                                       dict.get(user_data, "nickname") ))
+
+            self.names.build(users)
+            self._names_stale = False
+            logger.debug("name index built: {} users".format(len(self.names)))
+
+        return self.names
+
+    def _on_memory_change(self, op, keys_list):
+        """keep the name index current, see name_index()"""
+        if self._names_stale or (keys_list and keys_list[0] != "user_data"):
+            return
+
+        if len(keys_list) < 2:
+            # all of user_data was replaced, or memory was reloaded or tainted
+            self._names_stale = True
+            return
+
+        chat_id = keys_list[1]
+        if self.bot.memory.exists(["user_data", chat_id, "_hangups"]):
+            user_data = self.bot.memory.get_by_path(["user_data", chat_id])
+            self.names.update( chat_id,
+                               user_data["_hangups"].get("full_name") or "",
+                               user_data.get("nickname") )
+        else:
+            self.names.remove(chat_id)
+
     @asyncio.coroutine
     def load_from_memory(self):
         """load "persisted" conversations from memory.json into self.catalog
@@ -137,14 +387,22 @@ class conversation_memory:
             convs = self.bot.memory.get_by_path(['convmem'])
             logger.info("loading {} conversations from memory".format(len(convs)))
 
+            if not self._catalog_loaded:
+                yield from self.load_catalog()
+
             _users_added = {}
             _users_incomplete = {}
             _users_unknown = {}
 
             _users_to_fetch = []
 
-            for convid in convs:
-                self.catalog[convid] = convs[convid]
+            # handlers may add conversations while this yields, so loop over a copy
+            for convid in list(convs):
+                # let other tasks run between conversations when reconciling in the background
+                yield from asyncio.sleep(0)
+
+                if convid not in self.catalog:
+                    continue
 
                 if "participants" in self.catalog[convid] and len(self.catalog[convid]["participants"]) > 0:
                     for _chat_id in self.catalog[convid]["participants"]:
@@ -200,50 +458,45 @@ class conversation_memory:
             len(self.bot._conv_list._conv_dict)))
 
         for Conversation in self.bot._conv_list.get_all():
+            yield from asyncio.sleep(0)
             yield from self.update(Conversation, source="init", automatic_save=False)
 
 
     @asyncio.coroutine
     def get_users_from_query(self, chat_ids, batch_max=20):
-        """retrieve definitive user data by requesting it from the server"""
+        """retrieve definitive user data by requesting it from the server
+        chunks are requested concurrently (config.permamem.query_concurrency, default 4)
+        failed chunks are retried with backoff (config.permamem.query_retries, default 3)
+        """
 
         chat_ids = list(set(chat_ids))
 
         chunks = [ chat_ids[i:i+batch_max]
                    for i in range(0, len(chat_ids), batch_max) ]
 
-        updated_users = 0
-
-        for chunk in chunks:
-            logger.debug("getentitybyid(): {}".format(chunk))
+        concurrency = self.bot.get_config_option("permamem.query_concurrency") or 4
+        retries = self.bot.get_config_option("permamem.query_retries")
+        if retries is None:
+            retries = 3
 
-            try:
-                _request = hangups.hangouts_pb2.GetEntityByIdRequest(
-                    request_header=self.bot._client.get_request_header(),
-                    batch_lookup_spec=[ hangups.hangouts_pb2.EntityLookupSpec( gaia_id=chat_id) 
-                                        for chat_id in chunk ])
+        semaphore = asyncio.Semaphore(concurrency)
 
-                _response = yield from self.bot._client.get_entity_by_id(_request)
+        results = yield from asyncio.gather(*[ self._query_chunk(chunk, semaphore, retries)
+                                               for chunk in chunks ])
 
-                for _user in _response.entity:
-                    UserID = hangups.user.UserID(chat_id=_user.id.chat_id, gaia_id=_user.id.gaia_id)
-                    User = hangups.user.User(
-                        UserID,
-                        _user.properties.display_name,
-                        _user.properties.first_name,
-                        _user.properties.photo_url,
-                        list(_user.properties.email), # repeated field
-                        False)
+        """apply all results at once, then save once"""
 
-                    """this function usually called because hangups user list is incomplete, so help fill it in as well"""
-                    logger.debug("updating hangups user list {} ({})".format(User.id_.chat_id, User.full_name))
-                    self.bot._user_list._user_dict[User.id_] = User
+        updated_users = 0
 
-                    if self.store_user_memory(User, is_definitive=True, automatic_save=False):
-                        updated_users = updated_users + 1
+        for Users in results:
+            for User in Users:
+                """this function usually called because hangups user list is incomplete, so help fill it in as well"""
+                logger.debug("updating hangups user list {} ({})".format(User.id_.chat_id, User.full_name))
+                self.bot._user_list._user_dict[User.id_] = User
+                self._check_user_names(User)
 
-            except hangups.exceptions.NetworkError as e:
-                logger.exception("getentitybyid(): FAILED for chunk {}".format(chunk))
+                if self.store_user_memory(User, is_definitive=True, automatic_save=False):
+                    updated_users = updated_users + 1
 
         if updated_users > 0:
             self.bot.memory.save()
@@ -254,11 +507,51 @@ class conversation_memory:
 
         return updated_users
 
+    @asyncio.coroutine
+    def _query_chunk(self, chunk, semaphore, retries):
+        """returns list of hangups.user.User for the chunk, empty if all attempts failed"""
+        attempt = 0
+        while True:
+            with (yield from semaphore):
+                logger.debug("getentitybyid(): {}".format(chunk))
+
+                try:
+                    _request = hangups.hangouts_pb2.GetEntityByIdRequest(
+                        request_header=self.bot._client.get_request_header(),
+                        batch_lookup_spec=[ hangups.hangouts_pb2.EntityLookupSpec( gaia_id=chat_id)
+                                            for chat_id in chunk ])
+
+                    _response = yield from self.bot._client.get_entity_by_id(_request)
+
+                    Users = []
+                    for _user in _response.entity:
+                        UserID = hangups.user.UserID(chat_id=_user.id.chat_id, gaia_id=_user.id.gaia_id)
+                        Users.append(hangups.user.User(
+                            UserID,
+                            _user.properties.display_name,
+                            _user.properties.first_name,
+                            _user.properties.photo_url,
+                            list(_user.properties.email), # repeated field
+                            False))
+
+                    return Users
+
+                except hangups.exceptions.NetworkError as e:
+                    if attempt >= retries:
+                        logger.exception("getentitybyid(): FAILED for chunk {}".format(chunk))
+                        return []
+
+            # back off outside the semaphore, so other chunks can proceed
+            attempt = attempt + 1
+            logger.warning("getentitybyid(): retrying chunk in {}s (attempt {})".format(2 ** attempt, attempt))
+            yield from asyncio.sleep(2 ** attempt)
+
 
     def store_user_memory(self, User, automatic_save=True, is_definitive=False):
         """update user memory based on supplied hangups User
         conservative writing: on User attribute changes only
         returns True on User change, False on no changes
+        a User identical to the last one stored is detected by fingerprint, without diffing
         """
 
         """in the event hangups returned an "unknown" user, turn off the is_definitive flag"""
@@ -266,6 +559,28 @@ class conversation_memory:
             logger.debug("user {} ({}) not definitive".format(User.id_.chat_id, User.full_name))
             is_definitive = False
 
+        chat_id = User.id_.chat_id
+        fingerprint = ( User.id_.gaia_id, User.full_name, User.first_name, User.photo_url,
+                        tuple(User.emails), User.is_self, is_definitive )
+
+        if self._user_fingerprints.get(chat_id) == (fingerprint, self._stored_user_state(chat_id)):
+            return False
+
+        changed = self._store_user_memory(User, automatic_save, is_definitive)
+
+        self._user_fingerprints[chat_id] = (fingerprint, self._stored_user_state(chat_id))
+
+        return changed
+
+    def _stored_user_state(self, chat_id):
+        """(updated, is_definitive) of the stored user, so changes made outside store_user_memory()
+        (e.g. resetunknownusers) invalidate the fingerprint"""
+        if self.bot.memory.exists(["user_data", chat_id, "_hangups"]):
+            cached = self.bot.memory.get_by_path(["user_data", chat_id, "_hangups"])
+            return (cached.get("updated"), cached.get("is_definitive"))
+        return None
+
+    def _store_user_memory(self, User, automatic_save, is_definitive):
         """load existing cached user, reject update if cache is_definitive and supplied is not"""
         cached = False
         if self.bot.memory.exists(["user_data", User.id_.chat_id, "_hangups"]):
@@ -281,8 +596,8 @@ class conversation_memory:
             changed = True
 
         user_dict ={
-            "chat_id": User.id_.chat_id,
-            "gaia_id": User.id_.gaia_id,
+            "chat_id": intern_value(User.id_.chat_id),
+            "gaia_id": intern_value(User.id_.gaia_id),
             "full_name": User.full_name,
             "first_name": User.first_name,
             "photo_url": User.photo_url,
@@ -327,6 +642,8 @@ class conversation_memory:
             user_dict["updated"] = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
             self.bot.memory.set_by_path(["user_data", User.id_.chat_id, "_hangups"], user_dict)
 
+            self.bot.invalidate_hangups_conversation(chat_id=User.id_.chat_id)
+
             if automatic_save:
                 self.bot.memory.save()
 
@@ -344,7 +661,73 @@ class conversation_memory:
         """update conversation memory based on supplied hangups Conversation
         conservative writing: on changed Conversation and/or User attribute changes
         return True on Conversation/User change, False on no changes
+        unchanged conversations are detected by fingerprint, see _conversation_fingerprint()
         """
+        fingerprint = self._conversation_fingerprint(conv)
+        if conv.id_ in self.catalog and self._conv_fingerprints.get(conv.id_) == fingerprint:
+            return False
+
+        changed = yield from self._update(conv, source, automatic_save)
+
+        # taken before the update: users completed by it change the fingerprint, and are
+        #   picked up by the next update
+        self._conv_fingerprints[conv.id_] = fingerprint
+
+        return changed
+
+    def _conversation_fingerprint(self, conv):
+        """the conversation version, bumped by membership, rename and otr events and by user
+        renames in the hangups user list, see conversation_changed() and watch_user_list()
+        without a watched user list, the values _update() reads from every participant are
+        compared instead, which costs O(participants) per event"""
+        if self._user_names is not None:
+            return self._conv_versions.get(conv.id_, 0)
+
+        return ( conv.name,
+                 conv.is_off_the_record,
+                 conv._conversation.type,
+                 tuple( ( User.id_.chat_id, User.full_name, User.first_name, User.photo_url,
+                          tuple(User.emails), User.is_self )
+                        for User in conv.users ))
+
+    def conversation_changed(self, conv_id):
+        """the hangups conversation changed (membership, name, otr), compare it on the next update()"""
+        self._conv_versions[conv_id] = self._conv_versions.get(conv_id, 0) + 1
+
+    def watch_user_list(self):
+        """hangups renames users in-place when conversation updates carry better names, so
+        wrap the UserList method it uses to mark the conversations of renamed users as changed
+        returns False if this version of hangups cannot be watched"""
+        user_list = getattr(self.bot, "_user_list", None)
+        add_user = getattr(user_list, "_add_user_from_conv_part", None)
+        if add_user is None:
+            logger.warning("hangups user list cannot be watched, conversations are compared by value")
+            return False
+
+        def _add_user_from_conv_part(conv_part):
+            User = add_user(conv_part)
+            self._check_user_names(User)
+            return User
+
+        user_list._add_user_from_conv_part = _add_user_from_conv_part
+
+        self._user_names = { User.id_.chat_id: (User.full_name, User.first_name)
+                             for User in user_list.get_all() }
+        return True
+
+    def _check_user_names(self, User):
+        if self._user_names is None:
+            return
+
+        names = (User.full_name, User.first_name)
+        chat_id = User.id_.chat_id
+        if self._user_names.get(chat_id) != names:
+            self._user_names[chat_id] = names
+            for conv_id in self.convs_by_chat_id.get(chat_id, ()):
+                self.conversation_changed(conv_id)
+
+    @asyncio.coroutine
+    def _update(self, conv, source, automatic_save):
         conv_title = name_from_hangups_conversation(conv)
 
         original = {}
@@ -368,7 +751,7 @@ class conversation_memory:
 
         for User in conv.users:
             if not User.is_self:
-                memory["participants"].append(User.id_.chat_id)
+                memory["participants"].append(intern_value(User.id_.chat_id))
 
             if User.full_name.upper() == "UNKNOWN" and User.first_name == User.full_name:
                 # XXX: crappy way to detect hangups users
@@ -439,7 +822,12 @@ class conversation_memory:
             memory["updated"] = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
             self.bot.memory.set_by_path(["convmem", conv.id_], memory)
 
-            self.catalog[conv.id_] = memory
+            self._unindex(conv.id_)
+            # share the dict memory holds (tracked storage may have wrapped it), never a copy
+            self.catalog[conv.id_] = self.bot.memory.get_by_path(["convmem", conv.id_])
+            self._index(conv.id_, self.catalog[conv.id_])
+
+            self.bot.invalidate_hangups_conversation(conv.id_)
 
             if automatic_save:
                 # if users_changed this would write those changes as well
@@ -467,7 +855,12 @@ class conversation_memory:
             if _cached["type"] == "GROUP":
                 logger.info("removing conv: {} {}".format(conv_id, _cached["title"]))
                 self.bot.memory.pop_by_path(["convmem", conv_id])
+                self._unindex(conv_id)
                 del self.catalog[conv_id]
+                self._conv_fingerprints.pop(conv_id, None)
+                self._conv_versions.pop(conv_id, None)
+
+                self.bot.invalidate_hangups_conversation(conv_id)
 
             else:
                 logger.warning("cannot remove conv: {} {} {}".format(
@@ -482,111 +875,101 @@ class conversation_memory:
     def get(self, filter=""):
         """get dictionary of conversations that matches filter term(s) (ALL if not supplied)
         supports sequential boolean operations, each term must be enclosed with brackets ( ... )
+        see compile_filter() for the supported terms
         """
 
-        terms = []
-        raw_filter = filter.strip()
-        operator = "start"
-        while raw_filter.startswith("("):
-            tokens = re.split(r"(?<!\\)(?:\\\\)*\)", raw_filter, maxsplit=1)
-            terms.append([operator, tokens[0][1:]])
-            if len(tokens) == 2:
-                raw_filter = tokens[1]
-                if not raw_filter:
-                    # finished consuming entire string
-                    pass
-                elif re.match(r"^\s*and\s*\(", raw_filter, re.IGNORECASE):
-                    operator = "and"
-                    raw_filter = tokens[1][raw_filter.index('('):].strip()
-                elif re.match(r"^\s*or\s*\(", raw_filter, re.IGNORECASE):
-                    operator = "or"
-                    raw_filter = tokens[1][raw_filter.index('('):].strip()
-                else:
-                    raise ValueError("invalid boolean operator near \"{}\"".format(raw_filter.strip()))
+        terms = compile_filter(filter)
 
-        if raw_filter or len(terms)==0:
-            # second condition is to ensure at least one term, even if blank
-            terms.append([operator, raw_filter])
+        logger.debug("get(): {}".format(terms))
 
-        sourcelist = self.catalog.copy()
-        matched = {}
+        # results are memoised until the catalog or tag indices change
+        tags = getattr(self.bot, "tags", None)
+        cache_key = (self.version, tags, tags and tags.version)
+        if cache_key != self._filter_cache_key:
+            self._filter_cache.clear()
+            self._positions.clear()
+            self._filter_cache_key = cache_key
 
-        logger.debug("get(): {}".format(terms))
+        if filter in self._filter_cache:
+            matched = self._filter_cache[filter]
 
-        for operator, term in terms:
-            if operator == "and":
-                sourcelist = matched
-                matched = {}
-
-            """extra search term types added here"""
-
-            if not term:
-                # return everything
-                matched = sourcelist
-
-            elif term.startswith("id:"):
-                # explicit request for single conv
-                convid = term[3:]
-                matched[convid] = sourcelist[convid]
-
-            elif term in sourcelist:
-                # prioritise exact convid matches
-                matched[term] = sourcelist[term]
-
-            elif term.startswith("text:"):
-                # perform case-insensitive search
-                filter_lower = term[5:].lower()
-                for convid, convdata in sourcelist.items():
-                    title_lower = convdata["title"].lower()
-                    if( filter_lower in title_lower
-                            or filter_lower in title_lower.replace(" ", "") ):
-                        matched[convid] = convdata
-
-            elif term.startswith("chat_id:"):
-                # return all conversations user is in
-                filter_chat_id = term[8:]
-                for convid, convdata in sourcelist.items():
-                    for chat_id in convdata["participants"]:
-                        if filter_chat_id == chat_id:
-                            matched[convid] = convdata
-
-            elif term.startswith("tag:"):
-                # return all conversations with the tag
-                filter_tag = term[4:]
-                if filter_tag in self.bot.tags.indices["tag-convs"]:
-                    for conv_id in self.bot.tags.indices["tag-convs"][filter_tag]:
-                        if conv_id in sourcelist:
-                            matched[conv_id] = sourcelist[conv_id]
-
-            elif term.startswith("type:"):
-                # return all conversations with matching type (case-insensitive)
-                filter_type = term[5:]
-                for convid, convdata in sourcelist.items():
-                    if convdata["type"].lower() == filter_type.lower():
-                        matched[convid] = convdata
-
-            elif term.startswith("minusers:"):
-                # return all conversations with number of users or higher
-                filter_numusers = term[9:]
-                for convid, convdata in sourcelist.items():
-                    if len(convdata["participants"]) >= int(filter_numusers):
-                        matched[convid] = convdata
-
-            elif term.startswith("maxusers:"):
-                # return all conversations with number of users or lower
-                filter_numusers = term[9:]
-                for convid, convdata in sourcelist.items():
-                    if len(convdata["participants"]) <= int(filter_numusers):
-                        matched[convid] = convdata
-
-            elif term.startswith("random:"):
-                # return random conversations based on selection threshold
-                filter_random = term[7:]
-                for convid, convdata in sourcelist.items():
-                    if random.random() <= float(filter_random):
-                        matched[convid] = convdata
-
-        return matched
+        else:
+            """sequential evaluation, same as the original behaviour:
+                "and" narrows the source to the previous matches
+                "or" adds matches from the current source"""
+            source = set(self.catalog)
+            matched = set()
+            for operator, kind, argument in terms:
+                if operator == "and":
+                    source = matched
+                    matched = set()
+                matched = matched | self._match_term(kind, argument, source)
+
+            # same order as the catalog, like the original scan over it
+            if not self._positions:
+                self._positions.update((convid, position) for position, convid in enumerate(self.catalog))
+            matched = tuple(sorted(matched, key=self._positions.__getitem__))
+
+            if not any(kind == "random" for operator, kind, argument in terms):
+                if len(self._filter_cache) >= 256:
+                    self._filter_cache.clear()
+                self._filter_cache[filter] = matched
+
+        return { convid: self.catalog[convid] for convid in matched }
+
+    def _match_term(self, kind, argument, source):
+        """set of conv_ids in source that match a single compiled term"""
+
+        """extra search term types added here, and in compile_filter()"""
+
+        if kind == "all":
+            # return everything
+            return source
+
+        elif kind == "id":
+            # explicit request for single conv
+            if argument not in source:
+                raise KeyError(argument)
+            return { argument }
+
+        elif kind == "convid":
+            # exact convid matches
+            return { argument } if argument in source else set()
+
+        elif kind == "text":
+            # perform case-insensitive search
+            return { convid for convid in source
+                     if argument in self.catalog[convid]["title"].lower()
+                         or argument in self.catalog[convid]["title"].lower().replace(" ", "") }
+
+        elif kind == "chat_id":
+            # return all conversations user is in
+            return self.convs_by_chat_id.get(argument, set()) & source
+
+        elif kind == "tag":
+            # return all conversations with the tag
+            return self.bot.tags.indices["tag-convs"].get(argument, set()) & source
+
+        elif kind == "type":
+            # return all conversations with matching type (case-insensitive)
+            return self.convs_by_type.get(argument, set()) & source
+
+        elif kind == "minusers":
+            # return all conversations with number of users or higher
+            return { convid for convid in source
+                     if len(self.catalog[convid]["participants"]) >= argument }
+
+        elif kind == "maxusers":
+            # return all conversations with number of users or lower
+            return { convid for convid in source
+                     if len(self.catalog[convid]["participants"]) <= argument }
+
+        elif kind == "random":
+            # return random conversations based on selection threshold
+            return { convid for convid in source
+                     if random.random() <= argument }
+
+        return set()
 
     def get_name(self, conv, truncate=False, fallback_string=False):
         """drop-in replacement for hangups.ui.utils.get_conv_name
@@ -520,12 +520,13 @@ def unload(bot, module_path):
                         logger.debug("deregistering tagged command {}".format(command_name))
                         del command.command_tagsets[command_name]
 
+            command.invalidate()
+
             for type in bot._handlers.pluggables:
-                for handler in bot._handlers.pluggables[type]:
+                for handler in list(bot._handlers.pluggables[type]):
                     if handler[2]["module.path"] == module_path:
                         logger.debug("removing handler {} {}".format(type, handler))
-                        bot._handlers.pluggables[type].remove(handler)
-                        tracking.deregister_handler(handler[0], handler[2]["module.path"])
+                        bot._handlers.deregister_handler(handler[0], type=type)
 
             shared = plugin["shared"]
             for shared_def in shared:
@@ -546,7 +547,7 @@ def unload(bot, module_path):
 
             if len(plugin["commands"]["argument.preprocessors"]) > 0:
                 for groupname in plugin["commands"]["argument.preprocessors"]:
-                    del command.preprocessors[groupname]
+                    command.deregister_argument_preprocessor_group(groupname)
 
             logger.info("{} unloaded".format(module_path))
 
@@ -63,8 +63,7 @@ def _issue_invite(bot, user_id, group_id, uses=1, expire_in=2592000, expiry=None
     invitation["updated"] = time.time()
 
     # write to user memory
-    bot.memory["invites"][invitation["id"]] = invitation
-    bot.memory.force_taint()
+    bot.memory.set_by_path(["invites", invitation["id"]], invitation)
     bot.memory.save()
 
     return invitation["id"]
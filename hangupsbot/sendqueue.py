@@ -0,0 +1,146 @@
+import asyncio, collections, logging, time
+
+import hangups
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """allow rate operations per second on average, with bursts of up to burst operations"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """seconds until a token is available, 0 if one is available now"""
+        if not self.rate:
+            return 0
+        self._refill()
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def take(self):
+        if self.rate:
+            self._tokens = self._tokens - 1
+
+
+class SendQueue:
+    """outbound dispatcher with one ordered queue per conversation
+    * messages to the same conversation are delivered strictly in order
+    * delivery can be shaped by a global and a per-conversation token bucket, rate and
+      conversation_rate are messages per second and 0 (the default) leaves delivery unlimited
+    * hangups.NetworkError is retried with exponential backoff
+    * enqueue() returns a future that resolves when the message has been delivered
+    """
+
+    def __init__( self, bot, rate=0, burst=10, conversation_rate=0, conversation_burst=3,
+                  retries=3, backoff=1 ):
+
+        self.bot = bot
+
+        self.conversation_rate = conversation_rate
+        self.conversation_burst = conversation_burst
+        self.retries = retries
+        self.backoff = backoff
+
+        self._bucket = TokenBucket(rate, burst)
+        self._queues = {} # conv_id: deque of (future, sender, enqueued)
+        self._buckets = {} # conv_id: TokenBucket, kept while the conversation has queued messages
+
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def enqueue(self, conv_id, sender):
+        """queue sender (no-argument callable returning a coroutine) for delivery to conv_id"""
+        future = asyncio.Future()
+
+        if conv_id not in self._queues:
+            self._queues[conv_id] = collections.deque()
+            self._buckets[conv_id] = TokenBucket(self.conversation_rate, self.conversation_burst)
+            asyncio.async(self._worker(conv_id))
+
+        self._queues[conv_id].append((future, sender, time.monotonic()))
+
+        return future
+
+    def stats(self):
+        depths = { conv_id: len(queue) for conv_id, queue in self._queues.items() }
+        return { "queued": sum(depths.values()),
+                 "conversations": depths,
+                 "sent": self.sent,
+                 "retried": self.retried,
+                 "failed": self.failed }
+
+    @asyncio.coroutine
+    def _throttle(self, bucket):
+        while True:
+            delay = max(bucket.delay(), self._bucket.delay())
+            if not delay:
+                break
+            yield from asyncio.sleep(delay)
+
+        bucket.take()
+        self._bucket.take()
+
+    @asyncio.coroutine
+    def _worker(self, conv_id):
+        queue = self._queues[conv_id]
+        bucket = self._buckets[conv_id]
+
+        try:
+            while queue:
+                future, sender, enqueued = queue.popleft()
+                if future.cancelled():
+                    continue
+
+                yield from self._throttle(bucket)
+                self.bot.latency.record("send", "queue wait", time.monotonic() - enqueued)
+
+                try:
+                    result = yield from self._deliver(conv_id, sender)
+                except Exception as e:
+                    self.failed = self.failed + 1
+                    if not future.cancelled():
+                        future.set_exception(e)
+                else:
+                    self.sent = self.sent + 1
+                    if not future.cancelled():
+                        future.set_result(result)
+
+        finally:
+            # no yield between the last empty check and removal, so enqueue() cannot be missed
+            del self._queues[conv_id]
+            del self._buckets[conv_id]
+
+    @asyncio.coroutine
+    def _deliver(self, conv_id, sender):
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                return (yield from sender())
+
+            except hangups.NetworkError:
+                if attempt >= self.retries:
+                    logger.exception("failed to deliver to {} after {} attempts".format(conv_id, attempt + 1))
+                    raise
+
+                delay = self.backoff * 2 ** attempt
+                attempt = attempt + 1
+                self.retried = self.retried + 1
+                logger.warning("retrying delivery to {} in {}s (attempt {})".format(conv_id, delay, attempt))
+                yield from asyncio.sleep(delay)
+
+            finally:
+                self.bot.latency.record("send", "delivery", time.monotonic() - started)
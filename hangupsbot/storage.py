@@ -0,0 +1,430 @@
+import collections, datetime, glob, json, logging, os, shutil, sqlite3, threading
+
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_path(data, keys_list):
+    """walk data by path (list of keys), list indices may be supplied as strings"""
+    for key in keys_list:
+        data = data[int(key) if isinstance(data, list) else key]
+    return data
+
+
+def copy_json(value):
+    """structural copy of JSON-compatible data, cheaper than copy.deepcopy"""
+    if isinstance(value, dict):
+        # bypass overridden accessors of tracked containers
+        return { key: copy_json(item) for key, item in dict.items(value) }
+    if isinstance(value, collections.Mapping):
+        return { key: copy_json(value[key]) for key in value }
+    if isinstance(value, (list, tuple)):
+        return [ copy_json(item) for item in value ]
+    return value
+
+
+class JSONStorage:
+    """full-rewrite JSON file storage with optional failsafe backups
+    this is the original memory.json/config.json behaviour
+
+    saving is split in two steps so the expensive part can run in an executor:
+    * prepare() runs on the thread that owns the data and returns a private copy
+    * write() serialises and writes that copy, it may be called from any thread
+    """
+
+    # whether prepare() makes use of individual changed paths
+    incremental = False
+
+    def __init__(self, filename, failsafe_backups=0):
+        self.filename = filename
+        self.failsafe_backups = failsafe_backups
+        self._write_lock = threading.Lock()
+
+    def _make_failsafe_backup(self):
+        try:
+            with open(self.filename) as f:
+                json.load(f)
+        except IOError:
+            return False
+        except ValueError:
+            logger.warning("{} is corrupted, aborting backup".format(self.filename))
+            return False
+
+        existing = sorted(glob.glob(self.filename + ".*.bak"))
+        while len(existing) > (self.failsafe_backups - 1):
+            os.remove(existing.pop(0))
+
+        backup_file = self.filename + "." + datetime.datetime.now().strftime("%Y%m%d%H%M%S") + ".bak"
+        shutil.copy2(self.filename, backup_file)
+
+        return True
+
+    def _recover_from_failsafe(self):
+        existing = sorted(glob.glob(self.filename + ".*.bak"))
+        while len(existing) > 0:
+            try:
+                recovery_filename = existing.pop()
+                with open(recovery_filename) as f:
+                    # test the file is valid json
+                    data = json.load(f)
+
+                shutil.copy2(recovery_filename, self.filename)
+                logger.info("recovery successful: {}".format(recovery_filename))
+                return data
+            except IOError:
+                pass
+            except ValueError:
+                logger.error("corrupted recovery: {}".format(self.filename))
+        return None
+
+    def load(self):
+        """return the stored data, or an empty dict if nothing has been stored yet"""
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+            logger.info("{} read".format(self.filename))
+
+        except IOError:
+            data = {}
+
+        except ValueError:
+            data = None
+            if self.failsafe_backups > 0:
+                data = self._recover_from_failsafe()
+            if data is None:
+                raise
+
+        return data
+
+    def prepare(self, data, changes=None):
+        """changes is ignored as the entire file is always rewritten"""
+        return copy_json(data)
+
+    def write(self, snapshot):
+        """returns number of bytes written"""
+        with self._write_lock:
+            if self.failsafe_backups:
+                self._make_failsafe_backup()
+
+            serialised = json.dumps(snapshot, indent=2, sort_keys=True)
+            with open(self.filename, 'w') as f:
+                f.write(serialised)
+                f.flush()
+                os.fsync(f.fileno())
+
+        return len(serialised)
+
+    def save(self, data, changes=None):
+        """write data to storage immediately, returns number of bytes written"""
+        return self.write(self.prepare(data, changes))
+
+
+class JournalStorage(JSONStorage):
+    """snapshot + append-only change journal
+
+    * the snapshot is a regular JSON file, identical in layout to JSONStorage
+    * each save appends one line per changed path to <filename>.journal:
+        {"op": "set", "path": [...], "value": ...}
+        {"op": "pop", "path": [...]}
+    * on load, the journal is replayed over the snapshot
+    * the journal is compacted into a new snapshot when it exceeds compact_after
+      records, or when a full write is requested (changes is None)
+    """
+
+    incremental = True
+
+    def __init__(self, filename, failsafe_backups=0, compact_after=500):
+        super().__init__(filename, failsafe_backups)
+        self.journal_filename = filename + ".journal"
+        self.compact_after = compact_after
+        self.journal_records = 0
+
+    def load(self):
+        data = super().load()
+        self.journal_records = self._replay(data)
+        return data
+
+    def _replay(self, data):
+        """apply journal records to data in order, returns number of records applied
+        a truncated final line (interrupted write) ends the replay"""
+        records = 0
+
+        try:
+            with open(self.journal_filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning("{} truncated after {} records".format(self.journal_filename, records))
+                        break
+
+                    try:
+                        parent = resolve_path(data, record["path"][:-1])
+                        key = record["path"][-1]
+                        if isinstance(parent, list):
+                            key = int(key)
+                        if record["op"] == "set":
+                            parent[key] = record["value"]
+                        elif record["op"] == "pop":
+                            parent.pop(key)
+                    except (KeyError, IndexError, TypeError, ValueError):
+                        # path superseded by a later record
+                        pass
+
+                    records = records + 1
+
+        except IOError:
+            return 0
+
+        if records:
+            logger.info("{} replayed {} records".format(self.journal_filename, records))
+
+        return records
+
+    def compact(self, snapshot):
+        """write a complete snapshot atomically, then discard the journal"""
+        if self.failsafe_backups:
+            self._make_failsafe_backup()
+
+        serialised = json.dumps(snapshot, indent=2, sort_keys=True)
+
+        temporary_filename = self.filename + ".tmp"
+        with open(temporary_filename, 'w') as f:
+            f.write(serialised)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_filename, self.filename)
+
+        # journal is idempotent against the new snapshot, so a crash here is harmless
+        with open(self.journal_filename, 'w'):
+            pass
+        self.journal_records = 0
+
+        logger.info("{} compacted".format(self.filename))
+
+        return len(serialised)
+
+    def prepare(self, data, changes=None):
+        if( changes is None
+                or not os.path.isfile(self.filename)
+                or self.journal_records + len(changes) >= self.compact_after ):
+            return ("compact", copy_json(data))
+
+        records = []
+        for op, path in changes:
+            if op == "set":
+                try:
+                    value = resolve_path(data, path)
+                except (KeyError, IndexError, TypeError, ValueError):
+                    # path was removed afterwards, a later pop record covers it
+                    continue
+                records.append({ "op": op, "path": path, "value": copy_json(value) })
+            else:
+                records.append({ "op": op, "path": path })
+
+        return ("append", records)
+
+    def write(self, snapshot):
+        action, payload = snapshot
+
+        with self._write_lock:
+            if action == "compact":
+                return self.compact(payload)
+
+            if not payload:
+                return 0
+
+            serialised = "".join(json.dumps(record, sort_keys=True) + "\n" for record in payload)
+            with open(self.journal_filename, 'a') as f:
+                f.write(serialised)
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_records = self.journal_records + len(payload)
+
+        return len(serialised)
+
+
+class LazySections(collections.MutableMapping):
+    """top-level mapping that reads each section from the database on first access"""
+
+    def __init__(self, storage, names):
+        self._storage = storage
+        self._names = collections.OrderedDict.fromkeys(names)
+        self._loaded = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._loaded[key]
+        except KeyError:
+            if key not in self._names:
+                raise
+            value = self._loaded[key] = self._storage.read_section(key)
+            return value
+
+    def __setitem__(self, key, value):
+        self._names[key] = None
+        self._loaded[key] = value
+
+    def __delitem__(self, key):
+        del self._names[key]
+        self._loaded.pop(key, None)
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def is_loaded(self, key):
+        return key in self._loaded
+
+
+class SQLiteStorage:
+    """local SQLite database storage
+
+    * each top-level key is a section, dictionary sections are stored as one
+      row per child key (e.g. user_data/<chat_id>), anything else as a single value
+    * sections are only read from the database when first accessed
+    * saves write the changed child keys inside a single transaction
+    * on first use, an existing JSON file at filename is imported
+    """
+
+    incremental = True
+
+    def __init__(self, filename, failsafe_backups=0, database=None):
+        self.filename = filename
+        self.database = database or os.path.splitext(filename)[0] + ".db"
+
+        # saves may run outside of the thread that opened the database
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.database, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sections (section TEXT PRIMARY KEY, value TEXT)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (section TEXT, key TEXT, value TEXT, "
+                "PRIMARY KEY (section, key))")
+
+    def load(self):
+        with self._lock:
+            names = [ row[0] for row in self._connection.execute("SELECT section FROM sections") ]
+
+        if not names and os.path.isfile(self.filename):
+            self.import_json(self.filename)
+            with self._lock:
+                names = [ row[0] for row in self._connection.execute("SELECT section FROM sections") ]
+
+        logger.info("{} opened, {} sections".format(self.database, len(names)))
+
+        return LazySections(self, names)
+
+    def read_section(self, section):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM sections WHERE section = ?", (section,)).fetchone()
+            if row is None:
+                raise KeyError(section)
+            if row[0] is not None:
+                return json.loads(row[0])
+            return { key: json.loads(value)
+                     for key, value in self._connection.execute(
+                        "SELECT key, value FROM entries WHERE section = ?", (section,)) }
+
+    def _write_section(self, cursor, section, value):
+        cursor.execute("DELETE FROM entries WHERE section = ?", (section,))
+        if isinstance(value, dict):
+            rows = [ (section, str(key), json.dumps(entry, sort_keys=True))
+                     for key, entry in value.items() ]
+            cursor.execute("INSERT OR REPLACE INTO sections VALUES (?, NULL)", (section,))
+            cursor.executemany("INSERT INTO entries VALUES (?, ?, ?)", rows)
+            return sum(len(row[2]) for row in rows)
+        else:
+            serialised = json.dumps(value, sort_keys=True)
+            cursor.execute("INSERT OR REPLACE INTO sections VALUES (?, ?)", (section, serialised))
+            return len(serialised)
+
+    def prepare(self, data, changes=None):
+        """returns a list of database operations with private copies of the values"""
+        if changes is None:
+            return [ ("reset", None, None, None) ] + [
+                ("section", section, None, copy_json(data[section])) for section in list(data) ]
+
+        operations = []
+        for op, path in changes:
+            section = path[0]
+
+            if section not in data:
+                operations.append(("delete", section, None, None))
+                continue
+
+            value = data[section]
+            if len(path) == 1 or not isinstance(value, dict):
+                operations.append(("section", section, None, copy_json(value)))
+                continue
+
+            key = path[1]
+            if key in value:
+                operations.append(("entry", section, key, copy_json(value[key])))
+            else:
+                operations.append(("delete", section, key, None))
+
+        return operations
+
+    def write(self, snapshot):
+        """apply operations from prepare() in a single transaction
+        returns approximate number of bytes written"""
+        written = 0
+
+        with self._lock, self._connection:
+            cursor = self._connection.cursor()
+
+            for op, section, key, value in snapshot:
+                if op == "reset":
+                    cursor.execute("DELETE FROM sections")
+                    cursor.execute("DELETE FROM entries")
+
+                elif op == "section":
+                    written = written + self._write_section(cursor, section, value)
+
+                elif op == "entry":
+                    serialised = json.dumps(value, sort_keys=True)
+                    cursor.execute("INSERT OR IGNORE INTO sections VALUES (?, NULL)", (section,))
+                    cursor.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                                   (section, str(key), serialised))
+                    written = written + len(serialised)
+
+                elif key is None:
+                    cursor.execute("DELETE FROM sections WHERE section = ?", (section,))
+                    cursor.execute("DELETE FROM entries WHERE section = ?", (section,))
+
+                else:
+                    cursor.execute("DELETE FROM entries WHERE section = ? AND key = ?",
+                                   (section, str(key)))
+
+        return written
+
+    def save(self, data, changes=None):
+        return self.write(self.prepare(data, changes))
+
+    def import_json(self, filename):
+        """one-shot migration: replace database contents with a JSON file"""
+        with open(filename) as f:
+            data = json.load(f)
+        self.save(data)
+        logger.info("imported {} into {}".format(filename, self.database))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+backends = { "json": JSONStorage,
+             "journal": JournalStorage,
+             "sqlite": SQLiteStorage }
+
+
+def create(backend, filename, **options):
+    """construct a storage backend by name, options are passed to the backend constructor"""
+    if backend not in backends:
+        raise ValueError("unknown storage backend: {}".format(backend))
+    return backends[backend](filename, **options)
@@ -16,9 +16,16 @@ class tags:
 
     bot = None
     indices = {}
+    version = 0 # incremented on every index change
 
     def __init__(self, bot):
         self.bot = bot
+
+        # active tag caches, invalidated by add_to_index(), remove_from_index() and catalog changes
+        self._useractive = {} # chat_id: { conv_id: active tags }
+        self._convactive = {} # conv_id: active tags
+        self._catalog_version = None
+
         self.refresh_indices()
 
     def _load_from_memory(self, key, type):
@@ -30,6 +37,9 @@ class tags:
 
     def refresh_indices(self):
         self.indices = { "user-tags": {}, "tag-users":{}, "conv-tags": {}, "tag-convs": {} }
+        self.version = self.version + 1
+        self._useractive.clear()
+        self._convactive.clear()
 
         self._load_from_memory("user_data", "user")
         self._load_from_memory("conv_data", "conv")
@@ -44,37 +54,60 @@ class tags:
 
         logger.info("refreshed")
 
+    def _invalidate(self, type, id):
+        """drop cached active tags that depend on the index entry for id"""
+        if type == "user":
+            # id is either chat_id or conv_id|chat_id, wildcards can match any cached user
+            chat_id = id.rsplit("|", 1)[-1]
+            if chat_id == self.wildcard["user"]:
+                self._useractive.clear()
+            else:
+                self._useractive.pop(chat_id, None)
+
+        elif id in (self.wildcard["group"], self.wildcard["one2one"], self.wildcard["conversation"]):
+            self._convactive.clear()
+
+        else:
+            self._convactive.pop(id, None)
+
+    def _check_catalog_version(self):
+        """conversation type and existence are part of the active tag lookup, see permamem"""
+        catalog_version = self.bot.conversations.version
+        if catalog_version != self._catalog_version:
+            self._useractive.clear()
+            self._convactive.clear()
+            self._catalog_version = catalog_version
+
     def add_to_index(self, type, tag, id):
         tag_to_object = "tag-{}s".format(type)
         object_to_tag = "{}-tags".format(type)
 
-        if tag not in self.indices[tag_to_object]:
-            self.indices[tag_to_object][tag] = []
-        if id not in self.indices[tag_to_object][tag]:
-            self.indices[tag_to_object][tag].append(id)
+        self.version = self.version + 1
+        self._invalidate(type, id)
 
-        if id not in self.indices[object_to_tag]:
-            self.indices[object_to_tag][id] = []
-        if tag not in self.indices[object_to_tag][id]:
-            self.indices[object_to_tag][id].append(tag)
+        self.indices[tag_to_object].setdefault(tag, set()).add(id)
+        self.indices[object_to_tag].setdefault(id, set()).add(tag)
 
     def remove_from_index(self, type, tag, id):
         tag_to_object = "tag-{}s".format(type)
         object_to_tag = "{}-tags".format(type)
 
-        if tag in self.indices[tag_to_object]:
-            if id in self.indices[tag_to_object][tag]:
-                self.indices[tag_to_object][tag].remove(id)
-                if len(self.indices[tag_to_object][tag]) == 0:
-                    # remove key entirely it its empty
-                    del(self.indices[tag_to_object][tag])
+        self.version = self.version + 1
+        self._invalidate(type, id)
+
+        ids = self.indices[tag_to_object].get(tag)
+        if ids is not None:
+            ids.discard(id)
+            if not ids:
+                # remove key entirely it its empty
+                del self.indices[tag_to_object][tag]
 
-        if id in self.indices[object_to_tag]:
-            if tag in self.indices[object_to_tag][id]:
-                self.indices[object_to_tag][id].remove(tag)
-                if len(self.indices[object_to_tag][id]) == 0:
-                    # remove key entirely it its empty
-                    del(self.indices[object_to_tag][id])
+        tags = self.indices[object_to_tag].get(id)
+        if tags is not None:
+            tags.discard(tag)
+            if not tags:
+                # remove key entirely it its empty
+                del self.indices[object_to_tag][id]
 
     def update(self, type, id, action, tag):
         updated = False
@@ -234,10 +267,24 @@ class tags:
         return records_removed
 
 
+    def _merge_active(self, index, check_keys):
+        """tags of the first key present in index, merged with the following keys while tagging-merge is active"""
+        active_tags = set()
+        for _key in check_keys:
+            if _key in index:
+                active_tags.update(index[_key])
+                if "tagging-merge" not in active_tags:
+                    break
+        return active_tags
+
     def convactive(self, conv_id):
         """return active tags for conv_id, or generic GROUP, ONE_TO_ONE keys"""
 
-        active_tags = []
+        self._check_catalog_version()
+
+        if conv_id in self._convactive:
+            return list(self._convactive[conv_id])
+
         check_keys = []
 
         if conv_id in self.bot.conversations.catalog:
@@ -250,23 +297,27 @@ class tags:
                 check_keys.extend([ self.wildcard["one2one"] ])
             check_keys.extend([ self.wildcard["conversation"] ])
         else:
+            # not cached, the conversation may still be added to the catalog
             logger.warning("convactive: conversation {} does not exist".format(conv_id))
+            return []
 
-        for _key in check_keys:
-            if _key in self.indices["conv-tags"]:
-                active_tags.extend(self.indices["conv-tags"][_key])
-                active_tags = list(set(active_tags))
-                if "tagging-merge" not in active_tags:
-                    break
+        active_tags = self._merge_active(self.indices["conv-tags"], check_keys)
+        self._convactive[conv_id] = frozenset(active_tags)
 
-        return active_tags
+        return list(active_tags)
 
 
     def useractive(self, chat_id, conv_id="*"):
         """return active tags of user for current conv_id if supplied, globally if not"""
 
-        active_tags = []
+        self._check_catalog_version()
+
+        cached = self._useractive.get(chat_id)
+        if cached is not None and conv_id in cached:
+            return list(cached[conv_id])
+
         check_keys = []
+        cacheable = True
 
         if self.bot.memory.exists(["user_data", chat_id]):
             if conv_id != "*":
@@ -285,21 +336,21 @@ class tags:
 
                 else:
                     logger.warning("useractive: conversation {} does not exist".format(conv_id))
+                    cacheable = False
 
             check_keys.extend([ chat_id,
                                 self.wildcard["user"] ])
 
         else:
+            # not cached, the user may still be added to memory
             logger.warning("useractive: user {} does not exist".format(chat_id))
+            return []
 
-        for _key in check_keys:
-            if _key in self.indices["user-tags"]:
-                active_tags.extend(self.indices["user-tags"][_key])
-                active_tags = list(set(active_tags))
-                if "tagging-merge" not in active_tags:
-                    break
+        active_tags = self._merge_active(self.indices["user-tags"], check_keys)
+        if cacheable:
+            self._useractive.setdefault(chat_id, {})[conv_id] = frozenset(active_tags)
 
-        return active_tags
+        return list(active_tags)
 
 
     def userlist(self, conv_id, tags=False):
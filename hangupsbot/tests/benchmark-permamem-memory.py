@@ -0,0 +1,145 @@
+"""memory benchmark for permamem catalog loading and id interning
+usage: benchmark-permamem-memory.py [-h] [-u USERS] [-c CONVERSATIONS] [-p PARTICIPANTS]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -u USERS, --users USERS
+                        number of synthetic users (default 20000)
+  -c CONVERSATIONS, --conversations CONVERSATIONS
+                        number of synthetic conversations (default 5000)
+  -p PARTICIPANTS, --participants PARTICIPANTS
+                        participants per group conversation (default 12)
+
+builds a synthetic memory.json in-process, then reports traced allocations for:
+* the loaded memory
+* conversation_memory.compact_memory(), which interns ids repeated across user_data and convmem
+* conversation_memory.load_catalog(), whose entries are the convmem dicts themselves, so only
+  the catalog mapping and its reverse indexes are new allocations
+
+example usage:
+python3 benchmark-permamem-memory.py --users 50000 --conversations 10000
+"""
+import argparse, asyncio, json, os, random, sys, tracemalloc
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-u', '--users', type=int, default=20000, help="number of synthetic users")
+parser.add_argument('-c', '--conversations', type=int, default=5000, help="number of synthetic conversations")
+parser.add_argument('-p', '--participants', type=int, default=12, help="participants per group conversation")
+
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import permamem
+
+
+class FakeMemory:
+    def __init__(self, data):
+        self.data = data
+
+    def exists(self, path):
+        try:
+            self.get_by_path(path)
+            return True
+        except (KeyError, TypeError):
+            return False
+
+    def get_by_path(self, path):
+        value = self.data
+        for key in path:
+            value = value[key]
+        return value
+
+    def section_loaded(self, key):
+        return True
+
+
+class FakeBot:
+    def __init__(self, data):
+        self.memory = FakeMemory(data)
+
+
+def synthetic_memory_json():
+    random.seed(0)
+    chat_ids = [ str(100000000000000000000 + i) for i in range(args.users) ]
+
+    user_data = {}
+    for chat_id in chat_ids:
+        user_data[chat_id] = { "_hangups": { "chat_id": chat_id,
+                                             "gaia_id": chat_id,
+                                             "full_name": "user " + chat_id[-6:],
+                                             "first_name": "user",
+                                             "photo_url": "//lh3.googleusercontent.com/" + chat_id,
+                                             "emails": [],
+                                             "is_self": False,
+                                             "is_definitive": True,
+                                             "updated": "20160101000000" }}
+
+    convmem = {}
+    for i in range(args.conversations):
+        if i % 2:
+            participants = random.sample(chat_ids, min(args.participants, len(chat_ids)))
+            type_ = "GROUP"
+        else:
+            participants = [ chat_ids[i % len(chat_ids)] ]
+            type_ = "ONE_TO_ONE"
+            user_data[participants[0]]["1on1"] = "conv{}".format(i)
+
+        convmem["conv{}".format(i)] = { "title": "conversation {}".format(i),
+                                        "type": type_,
+                                        "history": True,
+                                        "participants": participants,
+                                        "source": "init",
+                                        "updated": "20160101000000" }
+
+    return json.dumps({ "user_data": user_data, "convmem": convmem })
+
+
+def traced(function):
+    """returns (result, change in traced memory), which is negative if function released memory
+    tracing must already be running, or memory freed by function would not be subtracted"""
+    before = tracemalloc.get_traced_memory()[0]
+    result = function()
+    after = tracemalloc.get_traced_memory()[0]
+    return result, after - before
+
+
+def report(label, size, per=None, count=None):
+    line = "{:<40} {:>+10.1f} KiB".format(label, size / 1024)
+    if per:
+        line = line + "  ({:+.0f} bytes per {})".format(size / count, per)
+    print(line)
+
+
+def id_objects(data):
+    """(distinct ids, distinct string objects holding them) across user_data and convmem"""
+    values = []
+    for conv in data["convmem"].values():
+        values.extend(conv["participants"])
+    for user in data["user_data"].values():
+        values.extend([ user["_hangups"]["chat_id"], user["_hangups"]["gaia_id"] ])
+    return len(set(values)), len({ id(value) for value in values })
+
+
+raw = synthetic_memory_json()
+
+print("{} users, {} conversations, {} bytes of json".format(args.users, args.conversations, len(raw)))
+
+tracemalloc.start()
+data, size_loaded = traced(lambda: json.loads(raw))
+report("loaded memory", size_loaded)
+
+print("before compaction: {} distinct ids held by {} string objects".format(*id_objects(data)))
+
+conversations = permamem.conversation_memory(FakeBot(data))
+
+_, size_compacted = traced(conversations.compact_memory)
+report("compact_memory()", size_compacted, "user", args.users)
+print("after compaction: {} distinct ids held by {} string objects".format(*id_objects(data)))
+
+loop = asyncio.get_event_loop()
+_, size_catalog = traced(lambda: loop.run_until_complete(conversations.load_catalog()))
+report("load_catalog() with indexes", size_catalog, "conversation", args.conversations)
+
+shared = all(conversations.catalog[conv_id] is conv for conv_id, conv in data["convmem"].items())
+print("catalog entries shared with memory: {}".format(shared))
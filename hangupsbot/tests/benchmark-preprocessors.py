@@ -0,0 +1,82 @@
+"""benchmark for command argument preprocessing (CommandDispatcher.preprocess_arguments)
+usage: benchmark-preprocessors.py [-h] [-a ARGUMENTS] [-g GROUPS] [-p PATTERNS]
+                                  [-m MATCHING] [-i INVOCATIONS]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -a ARGUMENTS, --arguments ARGUMENTS
+                        arguments per command invocation (default 20)
+  -g GROUPS, --groups GROUPS
+                        registered preprocessor groups, in addition to inbuilt (default 3)
+  -p PATTERNS, --patterns PATTERNS
+                        patterns per preprocessor group (default 5)
+  -m MATCHING, --matching MATCHING
+                        fraction of arguments that match a preprocessor pattern (default 0.1)
+  -i INVOCATIONS, --invocations INVOCATIONS
+                        number of command invocations (default 20000)
+
+preprocessor groups are synthetic and registered in-process, arguments are plain words with a
+fraction of tokens matching one of the registered patterns. inbuilt resolvers (@user, #conv)
+are registered but not matched, so no user or conversation memory is needed.
+
+example usage:
+python3 benchmark-preprocessors.py --arguments 50 --groups 10
+"""
+import argparse, os, random, sys, time, types
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-a', '--arguments', type=int, default=20, help="arguments per command invocation")
+parser.add_argument('-g', '--groups', type=int, default=3, help="registered preprocessor groups, in addition to inbuilt")
+parser.add_argument('-p', '--patterns', type=int, default=5, help="patterns per preprocessor group")
+parser.add_argument('-m', '--matching', type=float, default=0.1, help="fraction of arguments that match a preprocessor pattern")
+parser.add_argument('-i', '--invocations', type=int, default=20000, help="number of command invocations")
+
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import plugins
+
+from commands import CommandDispatcher
+
+
+class FakeBot:
+    def get_config_option(self, option):
+        return None
+
+
+def resolver(token, internal_context):
+    return token.upper()
+
+
+random.seed(0)
+
+dispatcher = CommandDispatcher()
+dispatcher.set_bot(FakeBot())
+plugins.tracking.reset()
+
+started = time.perf_counter()
+for group in range(args.groups):
+    dispatcher.register_argument_preprocessor_group(
+        "group{}".format(group),
+        { r"^%g{}p{}:\w+$".format(group, pattern): resolver for pattern in range(args.patterns) })
+print("{} groups of {} patterns registered in {:.2f}ms".format(
+    args.groups, args.patterns, (time.perf_counter() - started) * 1000))
+
+def argument():
+    if args.groups and random.random() < args.matching:
+        return "%g{}p{}:value".format(random.randrange(args.groups), random.randrange(args.patterns))
+    return random.choice([ "word", "another", "12345", "http://example.com/path", "some-option" ])
+
+invocations = [ [ argument() for i in range(args.arguments) ] for j in range(args.invocations) ]
+context = types.SimpleNamespace(command_path="benchmark.command")
+
+started = time.perf_counter()
+for command_args in invocations:
+    dispatcher.preprocess_arguments(command_args, internal_context=context)
+elapsed = time.perf_counter() - started
+
+print("{} invocations of {} arguments: {:.2f}us per invocation, {:.2f}us per argument".format(
+    args.invocations, args.arguments,
+    elapsed / args.invocations * 1000000,
+    elapsed / args.invocations / args.arguments * 1000000))
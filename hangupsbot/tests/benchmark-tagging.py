@@ -0,0 +1,113 @@
+"""microbenchmark for tag index maintenance and active tag resolution
+usage: benchmark-tagging.py [-h] [-u USERS] [-c CONVERSATIONS] [-t TAGS] [-m MESSAGES]
+                            [-a ACTIVE]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -u USERS, --users USERS
+                        number of tagged users (default 10000)
+  -c CONVERSATIONS, --conversations CONVERSATIONS
+                        number of tagged conversations (default 1000)
+  -t TAGS, --tags TAGS  number of distinct tags (default 5)
+  -m MESSAGES, --messages MESSAGES
+                        number of simulated messages (default 100000)
+  -a ACTIVE, --active ACTIVE
+                        number of distinct (user, conversation) pairs sending messages (default 1000)
+
+builds the tags indices in-process with a fake bot, then reports:
+* the time to build the indices (tags.refresh_indices())
+* the cost of tags.useractive() per message, with every message checking the sender's tags
+  three times (handle_command, autoreply enable and disable), uncached and cached
+
+example usage:
+python3 benchmark-tagging.py --users 50000 --tags 20
+"""
+import argparse, os, random, sys, time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-u', '--users', type=int, default=10000, help="number of tagged users")
+parser.add_argument('-c', '--conversations', type=int, default=1000, help="number of tagged conversations")
+parser.add_argument('-t', '--tags', type=int, default=5, help="number of distinct tags")
+parser.add_argument('-m', '--messages', type=int, default=100000, help="number of simulated messages")
+parser.add_argument('-a', '--active', type=int, default=1000, help="number of distinct (user, conversation) pairs sending messages")
+
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import plugins
+import commands
+
+import tagging
+
+
+class FakeMemory:
+    def __init__(self, data):
+        self.data = data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def exists(self, path):
+        value = self.data
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                return False
+            value = value[key]
+        return True
+
+
+class FakeConversations:
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.version = 0
+
+
+class FakeBot:
+    def __init__(self, data, catalog):
+        self.memory = FakeMemory(data)
+        self.conversations = FakeConversations(catalog)
+
+
+def synthetic_bot():
+    random.seed(0)
+    tags = [ "tag{}".format(i) for i in range(args.tags) ]
+
+    user_data = { "user{}".format(i): { "tags": random.sample(tags, random.randint(1, len(tags))) }
+                  for i in range(args.users) }
+
+    catalog = {}
+    conv_data = {}
+    for i in range(args.conversations):
+        conv_id = "conv{}".format(i)
+        catalog[conv_id] = { "type": "GROUP" if i % 2 else "ONE_TO_ONE" }
+        conv_data[conv_id] = { "tags": random.sample(tags, 1),
+                               "tags-users": { "user{}".format(random.randrange(args.users)): ["tagging-merge"] }}
+
+    return FakeBot({ "user_data": user_data, "conv_data": conv_data }, catalog)
+
+
+bot = synthetic_bot()
+
+started = time.perf_counter()
+tags = tagging.tags(bot)
+print("{} users, {} conversations, {} tags: indices built in {:.3f}s".format(
+    args.users, args.conversations, args.tags, time.perf_counter() - started))
+
+active = [ ("user{}".format(random.randrange(args.users)), "conv{}".format(random.randrange(args.conversations)))
+           for i in range(args.active) ]
+messages = [ random.choice(active) for i in range(args.messages) ]
+
+
+def per_message(invalidate):
+    started = time.perf_counter()
+    for chat_id, conv_id in messages:
+        for tag in ("ignore", "autoreplies-enable", "autoreplies-disable"):
+            if invalidate:
+                tags._useractive.clear()
+            tag in tags.useractive(chat_id, conv_id)
+    return (time.perf_counter() - started) / len(messages)
+
+
+for label, invalidate in (("uncached", True), ("cached", False)):
+    print("{:<10} {:.2f}us per message".format(label, per_message(invalidate) * 1000000))
@@ -0,0 +1,354 @@
+"""offline throughput benchmark: replays synthetic hangups events through the full bot pipeline
+usage: benchmark-throughput.py [-h] [-e EVENTS] [-c CONVERSATIONS] [-u USERS]
+                               [-s PARTICIPANTS] [-p PLUGINS] [-r REPLY_EVERY]
+                               [--membership RATIO] [--rename RATIO]
+                               [--syncrooms SIZE] [--load PLUGIN [PLUGIN ...]]
+                               [--send-latency SECONDS] [--batch BATCH]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -e EVENTS, --events EVENTS
+                        number of events to replay (default 20000)
+  -c CONVERSATIONS, --conversations CONVERSATIONS
+                        number of group conversations (default 50)
+  -u USERS, --users USERS
+                        number of users (default 500)
+  -s PARTICIPANTS, --participants PARTICIPANTS
+                        participants per conversation (default 20)
+  -p PLUGINS, --plugins PLUGINS
+                        number of synthetic message handlers (default 5)
+  -r REPLY_EVERY, --reply-every REPLY_EVERY
+                        synthetic handlers reply to every nth message, 0 to never reply (default 10)
+  --membership RATIO    fraction of events that are membership changes (default 0.01)
+  --rename RATIO        fraction of events that are renames (default 0.01)
+  --syncrooms SIZE      enable syncrooms, grouping conversations into rooms of SIZE (default 0, disabled)
+  --load PLUGIN [PLUGIN ...]
+                        real plugins to load, as named in config.plugins (default none)
+  --send-latency SECONDS
+                        simulated round-trip for each sent message (default 0)
+  --batch BATCH         events replayed before waiting for the pipeline to drain (default 1000)
+
+the hangups client, user list and conversation list are replaced with in-process stubs, so
+no network access or cookies are needed. events are real hangups ChatMessageEvent,
+MembershipChangeEvent and RenameEvent objects, fed to HangupsBot._on_event(). reports
+events/sec, per-stage latency (bot.latency) and memory growth (tracemalloc).
+
+example usage:
+python3 benchmark-throughput.py --events 50000 --conversations 200 --syncrooms 4 --send-latency 0.01
+"""
+import argparse, asyncio, collections, itertools, json, logging, os, random, shutil, sys, tempfile, time, tracemalloc
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-e', '--events', type=int, default=20000, help="number of events to replay")
+parser.add_argument('-c', '--conversations', type=int, default=50, help="number of group conversations")
+parser.add_argument('-u', '--users', type=int, default=500, help="number of users")
+parser.add_argument('-s', '--participants', type=int, default=20, help="participants per conversation")
+parser.add_argument('-p', '--plugins', type=int, default=5, help="number of synthetic message handlers")
+parser.add_argument('-r', '--reply-every', type=int, default=10, help="synthetic handlers reply to every nth message")
+parser.add_argument('--membership', type=float, default=0.01, help="fraction of events that are membership changes")
+parser.add_argument('--rename', type=float, default=0.01, help="fraction of events that are renames")
+parser.add_argument('--syncrooms', type=int, default=0, help="enable syncrooms, grouping conversations into rooms of SIZE")
+parser.add_argument('--load', nargs="+", default=[], help="real plugins to load, as named in config.plugins")
+parser.add_argument('--send-latency', type=float, default=0, help="simulated round-trip for each sent message")
+parser.add_argument('--batch', type=int, default=1000, help="events replayed before waiting for the pipeline to drain")
+
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+logging.basicConfig(level=logging.WARNING)
+
+import hangups
+
+import hangupsbot
+import plugins
+
+from hangups import hangouts_pb2
+
+
+class Observable:
+    """minimal stand-in for hangups.event.Event"""
+    def __init__(self):
+        self.observers = []
+
+    def add_observer(self, callback):
+        self.observers.append(callback)
+
+    def remove_observer(self, callback):
+        self.observers.remove(callback)
+
+
+class StubClient:
+    def __init__(self, send_latency):
+        self.send_latency = send_latency
+        self.sent = 0
+        self._generated_ids = itertools.count(1)
+
+        self.on_connect = Observable()
+        self.on_disconnect = Observable()
+        self.on_state_update = Observable()
+
+    def get_request_header(self):
+        return hangouts_pb2.RequestHeader()
+
+    def get_client_generated_id(self):
+        return next(self._generated_ids)
+
+    @asyncio.coroutine
+    def send_chat_message(self, request):
+        if self.send_latency:
+            yield from asyncio.sleep(self.send_latency)
+        self.sent = self.sent + 1
+        return hangouts_pb2.SendChatMessageResponse()
+
+    @asyncio.coroutine
+    def get_entity_by_id(self, request):
+        return hangouts_pb2.GetEntityByIdResponse()
+
+
+class StubUserList:
+    def __init__(self, users, self_user):
+        self._user_dict = { user.id_: user for user in users }
+        self._user_dict[self_user.id_] = self_user
+        self._self_user = self_user
+
+    def get_all(self):
+        return list(self._user_dict.values())
+
+    def get_user(self, user_id):
+        return self._user_dict[user_id]
+
+
+class StubConversation:
+    """the parts of hangups.conversation.Conversation used by the bot"""
+    def __init__(self, conv_id, name, users):
+        self.id_ = conv_id
+        self.name = name
+        self.users = users
+        self.is_off_the_record = False
+        self._refresh()
+
+    def _refresh(self):
+        # hangups replaces _conversation whenever the server reports a changed conversation
+        self._conversation = hangouts_pb2.Conversation(
+            conversation_id = hangouts_pb2.ConversationId(id=self.id_),
+            type = hangouts_pb2.CONVERSATION_TYPE_GROUP,
+            name = self.name )
+        self._users_by_id = { user.id_: user for user in self.users }
+
+    def get_user(self, user_id):
+        return self._users_by_id[user_id]
+
+    def join(self, user):
+        self.users = self.users + [user]
+        self._refresh()
+
+    def rename(self, name):
+        self.name = name
+        self._refresh()
+
+
+class StubConversationList:
+    def __init__(self, conversations):
+        self._conv_dict = { conv.id_: conv for conv in conversations }
+        self.on_event = Observable()
+
+    def get_all(self):
+        return list(self._conv_dict.values())
+
+    def get(self, conv_id):
+        return self._conv_dict[conv_id]
+
+
+def make_user(chat_id, is_self=False):
+    return hangups.user.User( hangups.user.UserID(chat_id=chat_id, gaia_id=chat_id),
+                              "user {}".format(chat_id),
+                              "user",
+                              "//example.com/{}.png".format(chat_id),
+                              [ "{}@example.com".format(chat_id) ],
+                              is_self )
+
+
+_event_ids = itertools.count(1)
+
+def event_pb(conv_id, chat_id, **kwargs):
+    return hangouts_pb2.Event( conversation_id = hangouts_pb2.ConversationId(id=conv_id),
+                               sender_id = hangouts_pb2.ParticipantId(chat_id=chat_id, gaia_id=chat_id),
+                               timestamp = int(time.time() * 1000000),
+                               event_id = "benchmark-{}".format(next(_event_ids)),
+                               **kwargs )
+
+def chat_message(conv_id, chat_id, text):
+    return hangups.ChatMessageEvent(event_pb(
+        conv_id, chat_id,
+        event_type = hangouts_pb2.EVENT_TYPE_REGULAR_CHAT_MESSAGE,
+        chat_message = hangouts_pb2.ChatMessage(
+            message_content = hangouts_pb2.MessageContent(
+                segment = [ hangouts_pb2.Segment(type=hangouts_pb2.SEGMENT_TYPE_TEXT, text=text) ]))))
+
+def membership_change(conv_id, chat_id, joined_chat_id):
+    return hangups.MembershipChangeEvent(event_pb(
+        conv_id, chat_id,
+        event_type = hangouts_pb2.EVENT_TYPE_ADD_USER,
+        membership_change = hangouts_pb2.MembershipChange(
+            type = hangouts_pb2.MEMBERSHIP_CHANGE_TYPE_JOIN,
+            participant_ids = [ hangouts_pb2.ParticipantId(chat_id=joined_chat_id, gaia_id=joined_chat_id) ])))
+
+def rename(conv_id, chat_id, old_name, new_name):
+    return hangups.RenameEvent(event_pb(
+        conv_id, chat_id,
+        event_type = hangouts_pb2.EVENT_TYPE_RENAME_CONVERSATION,
+        conversation_rename = hangouts_pb2.ConversationRename(new_name=new_name, old_name=old_name)))
+
+
+def synthetic_handler(index):
+    counter = itertools.count(1)
+
+    @asyncio.coroutine
+    def handler(bot, event, command):
+        if event.from_bot:
+            return
+        if args.reply_every and next(counter) % args.reply_every == 0:
+            yield from bot.coro_send_message(event.conv_id, "handler {} saw: {}".format(index, event.text))
+
+    handler.__name__ = "handler{}".format(index)
+    return handler
+
+
+def build_world():
+    random.seed(0)
+
+    self_user = make_user("bot", is_self=True)
+    users = [ make_user("user{}".format(i)) for i in range(args.users) ]
+
+    conversations = []
+    for i in range(args.conversations):
+        participants = random.sample(users, min(args.participants, len(users))) + [self_user]
+        conversations.append(StubConversation("conv{}".format(i), "conversation {}".format(i), participants))
+
+    return self_user, users, conversations
+
+
+def write_config(directory, conversations):
+    config = { "admins": [],
+               "commands_admin": [],
+               "commands_enabled": True,
+               "plugins": args.load + (["syncrooms"] if args.syncrooms else []),
+               "send_queue": { "rate": 0, "conversation_rate": 0 },
+               "workaround.duplicate-events": False }
+
+    if args.syncrooms:
+        conv_ids = [ conv.id_ for conv in conversations ]
+        config["syncing_enabled"] = True
+        config["sync_rooms"] = [ conv_ids[i:i+args.syncrooms]
+                                 for i in range(0, len(conv_ids), args.syncrooms) ]
+
+    path = os.path.join(directory, "config.json")
+    with open(path, "w") as f:
+        json.dump(config, f)
+    return path
+
+
+@asyncio.coroutine
+def drain(baseline):
+    """wait until every task started since baseline has finished"""
+    while True:
+        pending = [ task for task in asyncio.Task.all_tasks()
+                    if task not in baseline and not task.done() and task is not asyncio.Task.current_task() ]
+        if not pending:
+            return
+        yield from asyncio.wait(pending)
+
+
+@asyncio.coroutine
+def replay(bot, users, conversations):
+    baseline = set(asyncio.Task.all_tasks())
+
+    dispatch = collections.defaultdict(float)
+    counts = collections.Counter()
+
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+
+    for n in range(args.events):
+        conv = random.choice(conversations)
+        sender = random.choice(conv.users[:-1])
+        roll = random.random()
+
+        if roll < args.membership:
+            joining = random.choice(users)
+            conv.join(joining)
+            conv_event, kind = membership_change(conv.id_, sender.id_.chat_id, joining.id_.chat_id), "membership"
+        elif roll < args.membership + args.rename:
+            old_name = conv.name
+            conv.rename("{} #{}".format(conv.id_, n))
+            conv_event, kind = rename(conv.id_, sender.id_.chat_id, old_name, conv.name), "rename"
+        else:
+            conv_event, kind = chat_message(conv.id_, sender.id_.chat_id, "message {}".format(n)), "message"
+
+        event_started = time.perf_counter()
+        yield from bot._on_event(conv_event)
+        dispatch[kind] = dispatch[kind] + time.perf_counter() - event_started
+        counts[kind] = counts[kind] + 1
+
+        if (n + 1) % args.batch == 0:
+            yield from drain(baseline)
+
+    yield from drain(baseline)
+
+    elapsed = time.perf_counter() - started
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("{} events in {:.2f}s: {:.0f} events/sec".format(args.events, elapsed, args.events / elapsed))
+    for kind, count in sorted(counts.items()):
+        print("... {:<10} {:>7} events, {:.1f}us mean _on_event()".format(kind, count, dispatch[kind] / count * 1000000))
+    print("messages sent: {} (send queue: {})".format(bot._client.sent, bot.send_queue.stats()))
+    print("memory: {:+.1f} KiB retained, {:.1f} KiB peak".format(
+        (memory_after - memory_before) / 1024, (memory_peak - memory_before) / 1024))
+    print("registries: {}".format(bot._handlers.registry_stats()))
+
+    print("per-stage latency:")
+    for category, summaries in bot.latency.summary().items():
+        for key, summary in sorted(summaries.items()):
+            print("... {:<10} {:<45} x{count:<7} p50 {p50:.6f}s p95 {p95:.6f}s p99 {p99:.6f}s max {max:.6f}s".format(
+                category, key, **summary))
+
+
+def main():
+    directory = tempfile.mkdtemp(prefix="hangupsbot-benchmark-")
+    try:
+        self_user, users, conversations = build_world()
+
+        bot = hangupsbot.HangupsBot( os.path.join(directory, "cookies.json"),
+                                     write_config(directory, conversations),
+                                     memory_file = os.path.join(directory, "memory.json") )
+
+        bot._client = StubClient(args.send_latency)
+
+        @asyncio.coroutine
+        def build_user_conversation_list(client):
+            return StubUserList(users, self_user), StubConversationList(conversations)
+
+        hangups.build_user_conversation_list = build_user_conversation_list
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(bot._on_connect())
+
+        for index in range(args.plugins):
+            bot._handlers.register_handler( synthetic_handler(index),
+                                            type = "message",
+                                            extra_metadata = { "module": "benchmark",
+                                                               "module.path": "benchmark.synthetic" })
+
+        loop.run_until_complete(replay(bot, users, conversations))
+        loop.run_until_complete(plugins.unload_all(bot))
+        bot.memory.flush()
+
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()